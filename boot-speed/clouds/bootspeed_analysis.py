@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Parse boot-speed measurement archives into structured timing records.
+
+The input archives are the ones written by measure-cloud.py (see
+gen_archivename), containing metadata.json and the bootspeed.sh artifacts
+of every instance_N/boot_M. Each archive is turned into a compact record
+made of columns (lists of the same length), all times in milliseconds:
+
+    metadata        the metadata.json content
+    boots           instance, boot, firmware, loader, kernel, initrd,
+                    userspace, total
+    blame           instance, boot, unit, time
+    critical_chain  instance, boot, unit, parent, at, took
+    cloudinit       instance, boot, stage, duration
+
+Copyright 2026 Canonical Ltd.
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import re
+import sys
+import tarfile
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+# bootspeed.sh artifacts we know how to parse
+parsed_artifacts = (
+    "systemd-analyze_time",
+    "systemd-analyze_blame",
+    "systemd-analyze_critical-chain",
+    "cloud-init.log",
+)
+
+boot_splits = ("firmware", "loader", "kernel", "initrd", "userspace")
+
+timespan_units = {
+    "d": 86400000,
+    "h": 3600000,
+    "min": 60000,
+    "s": 1000,
+    "ms": 1,
+    "us": 0.001,
+    "µs": 0.001,
+}
+timespan_re = re.compile(r"([0-9.]+)\s*(min|ms|us|µs|d|h|s)\b")
+
+
+def parse_timespan(text):
+    """Convert a systemd timespan (e.g. '1min 2.345s') to milliseconds"""
+    return sum(
+        float(value) * timespan_units[unit] for value, unit in timespan_re.findall(text)
+    )
+
+
+def parse_analyze_time(text):
+    """
+    Parse the output of `systemd-analyze time`, e.g.
+    Startup finished in 2.3s (kernel) + 1.2s (initrd) + 9.8s (userspace) = 13.3s
+    Returns a dictionary with the boot_splits and "total" as keys.
+    """
+    splits = dict.fromkeys(boot_splits + ("total",))
+    for line in text.splitlines():
+        if not line.startswith("Startup finished in"):
+            continue
+        for span, split in re.findall(r"(?:in|\+) (.+?) \((\w+)\)", line):
+            if split in splits:
+                splits[split] = parse_timespan(span)
+        total = re.search(r"= (.+)$", line)
+        if total:
+            splits["total"] = parse_timespan(total.group(1))
+        break
+
+    return splits
+
+
+def parse_analyze_blame(text):
+    """Parse `systemd-analyze blame`. Returns a list of (unit, time)."""
+    blame = []
+    for line in text.splitlines():
+        fields = line.rsplit(None, 1)
+        if len(fields) == 2:
+            blame.append((fields[1], parse_timespan(fields[0])))
+
+    return blame
+
+
+def parse_analyze_critical_chain(text):
+    """
+    Parse `systemd-analyze critical-chain`. Returns a list of
+    (unit, parent, at, took), where parent is the unit right above in the
+    chain (the one waiting for this one), None for the chain head.
+    """
+    chain = []
+    # Units by tree depth, to find the parent of each line.
+    stack = []
+    # The indent is made of spaces and tree characters only: units may
+    # start with non-word characters too (e.g. -.mount).
+    line_re = re.compile(r"^([\s└├│─]*)(\S+)(?: @(.+?))?(?: \+(.+))?$")
+    for line in text.splitlines():
+        match = line_re.match(line)
+        if not match:
+            continue
+        indent, unit, at, took = match.groups()
+        depth = len(indent) // 2
+        del stack[depth:]
+        parent = stack[-1] if stack else None
+        stack.append(unit)
+        chain.append(
+            (
+                unit,
+                parent,
+                parse_timespan(at) if at else None,
+                parse_timespan(took) if took else None,
+            )
+        )
+
+    return chain
+
+
+def parse_cloudinit_log(text):
+    """
+    Compute the duration of the top-level cloud-init stages (init-local,
+    init-network, modules-config, modules-final) from the start/finish
+    events in cloud-init.log. Returns a list of (stage, duration).
+
+    The log is appended to on every boot: only the events of the last boot,
+    after its "running 'init-local'" line, are used.
+    """
+    event_re = re.compile(
+        r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+) - .*?: (start|finish): ([\w-]+):"
+    )
+    boot_re = re.compile(r"Cloud-init v\. \S+ running 'init-local'")
+    lines = text.splitlines()
+    boot_starts = [pos for pos, line in enumerate(lines) if boot_re.search(line)]
+    if boot_starts:
+        lines = lines[boot_starts[-1] :]
+    starts = {}
+    durations = []
+    for line in lines:
+        match = event_re.match(line)
+        if not match:
+            continue
+        stamp, event, stage = match.groups()
+        stamp = dt.datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S,%f")
+        if event == "start":
+            starts[stage] = stamp
+        elif stage in starts:
+            elapsed = stamp - starts.pop(stage)
+            durations.append((stage, elapsed.total_seconds() * 1000))
+
+    return durations
+
+
+def new_record():
+    return {
+        "metadata": {},
+        "boots": {k: [] for k in ("instance", "boot") + boot_splits + ("total",)},
+        "blame": {k: [] for k in ("instance", "boot", "unit", "time")},
+        "critical_chain": {
+            k: [] for k in ("instance", "boot", "unit", "parent", "at", "took")
+        },
+        "cloudinit": {k: [] for k in ("instance", "boot", "stage", "duration")},
+    }
+
+
+def append_row(columns, **row):
+    for column, value in row.items():
+        columns[column].append(value)
+
+
+def add_boot(record, instance, boot, artifacts):
+    """Parse the artifacts (a name -> text dictionary) of a boot"""
+    ids = {"instance": instance, "boot": boot}
+
+    splits = parse_analyze_time(artifacts.get("systemd-analyze_time", ""))
+    append_row(record["boots"], **ids, **splits)
+
+    for unit, time in parse_analyze_blame(artifacts.get("systemd-analyze_blame", "")):
+        append_row(record["blame"], **ids, unit=unit, time=time)
+
+    critical_chain = artifacts.get("systemd-analyze_critical-chain", "")
+    for unit, parent, at, took in parse_analyze_critical_chain(critical_chain):
+        append_row(
+            record["critical_chain"], **ids, unit=unit, parent=parent, at=at, took=took
+        )
+
+    for stage, duration in parse_cloudinit_log(artifacts.get("cloud-init.log", "")):
+        append_row(record["cloudinit"], **ids, stage=stage, duration=duration)
+
+
+@contextmanager
+def open_archive(path):
+    """Open a measurement archive as a tar stream (.tar.gz or .tar.zst)"""
+    if not str(path).endswith(".zst"):
+        with tarfile.open(path, mode="r|*") as tar:
+            yield tar
+        return
+
+    import zstandard
+
+    with open(path, "rb") as rawfile:
+        with zstandard.ZstdDecompressor().stream_reader(rawfile) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                yield tar
+
+
+def analyze_archive(path):
+    """Parse a measurement archive. Returns its record (see module doc)."""
+    record = new_record()
+    # (instance, boot) -> {artifact name: text}
+    boots = {}
+    path_re = re.compile(r"instance_(\d+)/boot_(\d+)/([^/]+)$")
+
+    with open_archive(path) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if os.path.basename(member.name) == "metadata.json":
+                record["metadata"] = json.load(tar.extractfile(member))
+                continue
+            match = path_re.search(member.name)
+            if not match or match.group(3) not in parsed_artifacts:
+                continue
+            key = (int(match.group(1)), int(match.group(2)))
+            text = tar.extractfile(member).read().decode("utf-8", "replace")
+            boots.setdefault(key, {})[match.group(3)] = text
+
+    # A tar stream cut at a member boundary reads as a shorter archive:
+    # measure-cloud.py writes metadata.json after all the boot artifacts.
+    if not record["metadata"]:
+        raise ValueError("no metadata.json in %s, truncated archive?" % path)
+
+    for (instance, boot), artifacts in sorted(boots.items()):
+        add_boot(record, instance, boot, artifacts)
+
+    return record
+
+
+def analyze_archives(paths, workers=None):
+    """
+    Parse many archives on a process pool. Yields (path, record) as they
+    are parsed. The archives which fail to parse (e.g. truncated) are
+    skipped with a warning.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_archive, path): path for path in paths}
+        try:
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    record = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as exc:
+                    print("WARNING: skipping %s: %r" % (path, exc), file=sys.stderr)
+                    continue
+                yield path, record
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("archives", nargs="+", help="Measurement archives")
+    parser.add_argument(
+        "-j", "--jobs", help="Number of worker processes", type=int, default=None
+    )
+    parser.add_argument(
+        "-o", "--output", help="Output file (JSON lines), default: stdout"
+    )
+    args = parser.parse_args()
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    with output:
+        for path, record in analyze_archives(args.archives, args.jobs):
+            record["archive"] = os.path.basename(path)
+            output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
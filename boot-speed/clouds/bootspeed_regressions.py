@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Detect boot-speed regressions between image serials.
+
+Works on the results store written by bootspeed_store.py. Runs are split
+in series by (cloud, region, instance_type, release) and, within a series,
+ordered by image serial (YYYYMMDD[.N], compared numerically). The timings
+of every new serial are compared with those of the previous --window
+serials: a boot split, systemd unit (blame or critical-chain time) or
+cloud-init stage is flagged when its median got slower by both
+--min-delta ms and --min-ratio, and when a one-sided Mann-Whitney U test
+rejects "not slower" at --alpha (if there are enough samples to run it).
+Only the reboots are compared by default (see --boots): the first boot
+also runs the cloud-init first boot work.
+
+Checks are incremental: a serial is only analyzed again if new runs of it,
+or of its baseline serials, were added to the store since the last check.
+Found regressions are saved in the store and printed.
+
+Copyright 2026 Canonical Ltd.
+"""
+
+import argparse
+import datetime as dt
+import math
+import re
+import statistics
+
+import bootspeed_analysis
+import bootspeed_store
+
+series_fields = ("cloud", "region", "instance_type", "release")
+
+schema = """
+CREATE TABLE IF NOT EXISTS regression_checks (
+    cloud TEXT,
+    region TEXT,
+    instance_type TEXT,
+    release TEXT,
+    image_serial TEXT,
+    nruns INTEGER,
+    checked TEXT,
+    baseline_runs TEXT,
+    PRIMARY KEY (cloud, region, instance_type, release, image_serial)
+);
+
+CREATE TABLE IF NOT EXISTS regressions (
+    cloud TEXT,
+    region TEXT,
+    instance_type TEXT,
+    release TEXT,
+    image_serial TEXT,
+    baseline_serials TEXT,
+    source TEXT,
+    name TEXT,
+    baseline REAL,
+    current REAL,
+    pvalue REAL
+);
+CREATE INDEX IF NOT EXISTS regressions_serial
+    ON regressions (cloud, region, instance_type, release, image_serial);
+"""
+
+# (source, table, name column, value column) of the per-unit timings
+unit_timings = (
+    ("blame", "blame", "unit", "time"),
+    ("critical-chain", "critical_chain", "unit", "took"),
+    ("cloud-init", "cloudinit", "stage", "duration"),
+)
+
+series_where = " AND ".join("r.%s IS ?" % field for field in series_fields)
+
+
+def mann_whitney_greater(baseline, current):
+    """
+    One-sided Mann-Whitney U test, normal approximation: returns the
+    p-value of the hypothesis that current is not stochastically greater
+    than baseline.
+    """
+    ranked = sorted([(v, 0) for v in baseline] + [(v, 1) for v in current])
+    ranks = [0.0] * len(ranked)
+    i = 0
+    while i < len(ranked):
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        i = j + 1
+
+    n1, n2 = len(baseline), len(current)
+    rank_sum = sum(rank for rank, (_, group) in zip(ranks, ranked) if group == 1)
+    u_stat = rank_sum - n2 * (n2 + 1) / 2
+    sigma = math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+    if sigma == 0:
+        return 1.0
+    zscore = (u_stat - n1 * n2 / 2) / sigma
+    return 1 - statistics.NormalDist().cdf(zscore)
+
+
+def compare(baseline, current, min_delta, min_ratio, alpha):
+    """Returns (baseline median, current median, p-value) if slower, else None"""
+    base_median = statistics.median(baseline)
+    cur_median = statistics.median(current)
+    if cur_median - base_median < min_delta:
+        return None
+    if cur_median < base_median * (1 + min_ratio):
+        return None
+
+    pvalue = None
+    if len(baseline) >= 3 and len(current) >= 3:
+        pvalue = mann_whitney_greater(baseline, current)
+        if pvalue > alpha:
+            return None
+
+    return base_median, cur_median, pvalue
+
+
+def connect(path):
+    db = bootspeed_store.connect(path)
+    db.executescript(schema)
+    # Stores from before baseline_runs: their serials get checked again
+    columns = [row[1] for row in db.execute("PRAGMA table_info(regression_checks)")]
+    if "baseline_runs" not in columns:
+        db.execute("ALTER TABLE regression_checks ADD COLUMN baseline_runs TEXT")
+    return db
+
+
+def all_series(db):
+    return db.execute(
+        "SELECT DISTINCT %s FROM runs" % ", ".join(series_fields)
+    ).fetchall()
+
+
+def serial_key(serial):
+    """Sort key of image serials: 20240101.10 comes after 20240101.9"""
+    return [
+        int(part) if part.isdigit() else part
+        for part in re.split(r"(\d+)", serial or "")
+    ]
+
+
+def serials(db, series):
+    """Returns [(serial, nruns)] of a series, oldest serial first"""
+    rows = db.execute(
+        "SELECT r.image_serial, COUNT(*) FROM runs r WHERE %s "
+        "GROUP BY r.image_serial" % series_where,
+        series,
+    ).fetchall()
+    return sorted(rows, key=lambda row: serial_key(row[0]))
+
+
+def checked_serials(db, series):
+    """
+    Returns {serial: (nruns, baseline_runs)} at the time of the last check
+    """
+    where = " AND ".join("%s IS ?" % field for field in series_fields)
+    return {
+        serial: (nruns, baseline_runs)
+        for serial, nruns, baseline_runs in db.execute(
+            "SELECT image_serial, nruns, baseline_runs FROM regression_checks "
+            "WHERE " + where,
+            series,
+        )
+    }
+
+
+def timings(db, series, serial, boots="reboot"):
+    """
+    Returns {(source, name): [values]} for the runs of a serial, from the
+    boots selected by boots (see bootspeed_store.boot_kinds)
+    """
+    values = {}
+    params = list(series) + [serial]
+    boot_where = ""
+    if bootspeed_store.boot_kinds[boots]:
+        boot_where = " AND " + bootspeed_store.boot_kinds[boots]
+
+    for split in bootspeed_analysis.boot_splits + ("total",):
+        for (value,) in db.execute(
+            "SELECT t.%s FROM boots t JOIN runs r ON r.id = t.run_id "
+            "WHERE %s AND r.image_serial IS ? AND t.%s IS NOT NULL%s"
+            % (split, series_where, split, boot_where),
+            params,
+        ):
+            values.setdefault(("boot", split), []).append(value)
+
+    for source, table, name_column, value_column in unit_timings:
+        for name, value in db.execute(
+            "SELECT t.%s, t.%s FROM %s t JOIN runs r ON r.id = t.run_id "
+            "WHERE %s AND r.image_serial IS ? AND t.%s IS NOT NULL%s"
+            % (
+                name_column,
+                value_column,
+                table,
+                series_where,
+                value_column,
+                boot_where,
+            ),
+            params,
+        ):
+            values.setdefault((source, name), []).append(value)
+
+    return values
+
+
+def check_series(db, series, args):
+    """Check the new serials of a series. Returns the regressions found."""
+    serial_runs = serials(db, series)
+    checked = checked_serials(db, series)
+    cache = {}
+
+    def serial_timings(serial):
+        if serial not in cache:
+            cache[serial] = timings(db, series, serial, args.boots)
+        return cache[serial]
+
+    found = []
+    for pos, (serial, nruns) in enumerate(serial_runs):
+        window = serial_runs[max(0, pos - args.window) : pos]
+        # The baseline serials and their run counts, as checked
+        baseline_runs = " ".join("%s:%d" % run for run in window)
+        if checked.get(serial) == (nruns, baseline_runs):
+            continue
+
+        baseline_serials = [s for s, _ in window]
+        db.execute(
+            "DELETE FROM regressions WHERE %s AND image_serial IS ?"
+            % " AND ".join("%s IS ?" % field for field in series_fields),
+            list(series) + [serial],
+        )
+
+        if baseline_serials:
+            baseline = {}
+            for base_serial in baseline_serials:
+                for key, values in serial_timings(base_serial).items():
+                    baseline.setdefault(key, []).extend(values)
+
+            for key, values in serial_timings(serial).items():
+                if key not in baseline:
+                    continue
+                result = compare(
+                    baseline[key], values, args.min_delta, args.min_ratio, args.alpha
+                )
+                if result:
+                    row = tuple(series) + (serial, " ".join(baseline_serials))
+                    row += key + result
+                    found.append(row)
+                    db.execute(
+                        "INSERT INTO regressions VALUES (%s)" % ", ".join("?" * 11),
+                        row,
+                    )
+
+        db.execute(
+            "INSERT OR REPLACE INTO regression_checks (%s, image_serial, nruns, "
+            "checked, baseline_runs) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            % ", ".join(series_fields),
+            tuple(series)
+            + (serial, nruns, dt.datetime.utcnow().isoformat(), baseline_runs),
+        )
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--db", help="Results database (default: %(default)s)", default="bootspeed.db"
+    )
+    parser.add_argument(
+        "--window",
+        help="Number of previous serials in the baseline (default: %(default)s)",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--min-delta",
+        help="Minimum median slowdown in ms (default: %(default)s)",
+        type=float,
+        default=50,
+    )
+    parser.add_argument(
+        "--min-ratio",
+        help="Minimum relative median slowdown (default: %(default)s)",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--alpha",
+        help="Significance level of the U test (default: %(default)s)",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--boots",
+        help="Boots compared: first, reboot or all; --recheck after changing "
+        "it (default: %(default)s)",
+        choices=tuple(bootspeed_store.boot_kinds),
+        default="reboot",
+    )
+    parser.add_argument(
+        "--recheck", help="Check all the serials again", action="store_true"
+    )
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    with db:
+        if args.recheck:
+            db.execute("DELETE FROM regression_checks")
+        found = []
+        for series in all_series(db):
+            found += check_series(db, series, args)
+
+    for row in found:
+        cloud, region, inst_type, release, serial, base, source, name = row[:8]
+        base_median, cur_median, pvalue = row[8:]
+        print(
+            "%s %s %s %s: %s %s %.1f ms -> %.1f ms (serial %s vs %s%s)"
+            % (
+                cloud,
+                region,
+                inst_type,
+                release,
+                source,
+                name,
+                base_median,
+                cur_median,
+                serial,
+                base,
+                "" if pvalue is None else ", p=%.2g" % pvalue,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Append-only store of boot-speed results, with trend queries.
+
+Measurement archives are parsed with bootspeed_analysis and their records
+are appended to a SQLite database, indexed on the measurement metadata
+(cloud, region, instance_type, release, image_serial, date). Examples:
+
+    bootspeed_store.py ingest ec2-*.tar.gz
+    bootspeed_store.py query -r jammy -t t3.micro --days 90 -m userspace
+    bootspeed_store.py query -r noble -m blame -u=-.mount --boot reboot
+
+Units starting with "-" (like -.mount or -.slice) must be given as
+-u=UNIT or --unit=UNIT, else they are taken for an option.
+
+Copyright 2026 Canonical Ltd.
+"""
+
+import argparse
+import datetime as dt
+import os
+import sqlite3
+import sys
+
+import bootspeed_analysis
+
+metadata_fields = (
+    "cloud",
+    "region",
+    "availability_zone",
+    "instance_type",
+    "release",
+    "cloudimage_id",
+    "image_serial",
+)
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    archive TEXT UNIQUE NOT NULL,
+    date TEXT NOT NULL,
+    cloud TEXT,
+    region TEXT,
+    availability_zone TEXT,
+    instance_type TEXT,
+    release TEXT,
+    cloudimage_id TEXT,
+    image_serial TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_trend
+    ON runs (release, instance_type, cloud, date);
+CREATE INDEX IF NOT EXISTS runs_serial ON runs (cloud, release, image_serial);
+CREATE INDEX IF NOT EXISTS runs_region ON runs (cloud, region, date);
+
+CREATE TABLE IF NOT EXISTS boots (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    instance INTEGER,
+    boot INTEGER,
+    firmware REAL,
+    loader REAL,
+    kernel REAL,
+    initrd REAL,
+    userspace REAL,
+    total REAL
+);
+CREATE INDEX IF NOT EXISTS boots_run ON boots (run_id);
+
+CREATE TABLE IF NOT EXISTS blame (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    instance INTEGER,
+    boot INTEGER,
+    unit TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS blame_run_unit ON blame (run_id, unit);
+
+CREATE TABLE IF NOT EXISTS critical_chain (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    instance INTEGER,
+    boot INTEGER,
+    unit TEXT,
+    parent TEXT,
+    at REAL,
+    took REAL
+);
+CREATE INDEX IF NOT EXISTS critical_chain_run_unit ON critical_chain (run_id, unit);
+
+CREATE TABLE IF NOT EXISTS cloudinit (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    instance INTEGER,
+    boot INTEGER,
+    stage TEXT,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS cloudinit_run_stage ON cloudinit (run_id, stage);
+"""
+
+# Record section (and table) name -> columns, see bootspeed_analysis
+timing_tables = {
+    "boots": ("instance", "boot") + bootspeed_analysis.boot_splits + ("total",),
+    "blame": ("instance", "boot", "unit", "time"),
+    "critical_chain": ("instance", "boot", "unit", "parent", "at", "took"),
+    "cloudinit": ("instance", "boot", "stage", "duration"),
+}
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    return db
+
+
+def known_archives(db):
+    return {row[0] for row in db.execute("SELECT archive FROM runs")}
+
+
+def add_record(db, archive, record):
+    """Append the record of an archive (see bootspeed_analysis)"""
+    metadata = record["metadata"]
+    instance = metadata.get("instance", {})
+    cursor = db.execute(
+        "INSERT INTO runs (archive, date, %s) VALUES (?, ?, %s)"
+        % (", ".join(metadata_fields), ", ".join("?" * len(metadata_fields))),
+        [archive, metadata.get("date-rfc3339", "")]
+        + [instance.get(field) for field in metadata_fields],
+    )
+    run_id = cursor.lastrowid
+
+    for table, columns in timing_tables.items():
+        rows = zip(*(record[table][column] for column in columns))
+        db.executemany(
+            "INSERT INTO %s (run_id, %s) VALUES (?, %s)"
+            % (table, ", ".join(columns), ", ".join("?" * len(columns))),
+            ((run_id,) + row for row in rows),
+        )
+
+
+def ingest(db, paths, workers=None):
+    """Parse and append the archives not already in the store"""
+    known = known_archives(db)
+    new_paths = [p for p in paths if os.path.basename(p) not in known]
+    print(
+        "Ingesting %d new archives (%d known)"
+        % (len(new_paths), len(paths) - len(new_paths))
+    )
+
+    # The archives which fail to parse are skipped (see analyze_archives),
+    # and each archive is committed on its own: a bad archive, or an
+    # interrupted ingest, does not lose the others.
+    stored = 0
+    for path, record in bootspeed_analysis.analyze_archives(new_paths, workers):
+        with db:
+            add_record(db, os.path.basename(path), record)
+        stored += 1
+    print("Stored %d archives, skipped %d" % (stored, len(new_paths) - stored))
+
+
+# Boots selected by the --boot option: the first boot of an instance also
+# runs the cloud-init first boot work, its timings differ from reboots.
+boot_kinds = {
+    "first": "t.boot = 0",
+    "reboot": "t.boot > 0",
+    "all": None,
+}
+
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a sorted list"""
+    if not values:
+        return None
+    pos = (len(values) - 1) * pct / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def query(db, metric, filters, days=None, unit=None, group_by=None, boot="all"):
+    """
+    Returns {group: sorted values} of metric for the runs matching filters
+    (a metadata field -> value dictionary). metric is one of the boot
+    splits, "total", "blame" (time of unit) or "cloudinit" (duration of
+    stage unit). boot selects the boots (see boot_kinds).
+    """
+    if metric == "blame":
+        table, column, match = "blame", "time", "unit"
+    elif metric == "cloudinit":
+        table, column, match = "cloudinit", "duration", "stage"
+    else:
+        table, column, match = "boots", metric, None
+
+    where = ["t.%s IS NOT NULL" % column]
+    params = []
+    for field, value in filters.items():
+        where.append("r.%s = ?" % field)
+        params.append(value)
+    if days:
+        cutoff = dt.datetime.utcnow() - dt.timedelta(days=days)
+        where.append("r.date >= ?")
+        params.append(cutoff.isoformat())
+    if match:
+        where.append("t.%s = ?" % match)
+        params.append(unit)
+    if boot_kinds[boot]:
+        where.append(boot_kinds[boot])
+
+    group = "r.%s" % group_by if group_by else "''"
+    sql = "SELECT %s, t.%s FROM %s t JOIN runs r ON r.id = t.run_id WHERE %s" % (
+        group,
+        column,
+        table,
+        " AND ".join(where),
+    )
+
+    groups = {}
+    for key, value in db.execute(sql, params):
+        groups.setdefault(key, []).append(value)
+    for values in groups.values():
+        values.sort()
+
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--db", help="Results database (default: %(default)s)", default="bootspeed.db"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Add measurement archives")
+    ingest_parser.add_argument("archives", nargs="+")
+    ingest_parser.add_argument(
+        "-j", "--jobs", help="Number of parser processes", type=int, default=None
+    )
+
+    query_parser = subparsers.add_parser("query", help="Boot time percentiles")
+    query_parser.add_argument(
+        "-m",
+        "--metric",
+        help="Boot metric (default: %(default)s)",
+        choices=bootspeed_analysis.boot_splits + ("total", "blame", "cloudinit"),
+        default="userspace",
+    )
+    query_parser.add_argument(
+        "-u",
+        "--unit",
+        help="systemd unit (blame) or cloud-init stage (cloudinit), as -u=UNIT"
+        " for the units starting with - (e.g. -u=-.mount)",
+    )
+    query_parser.add_argument("-c", "--cloud")
+    query_parser.add_argument("--region")
+    query_parser.add_argument("-t", "--instance-type")
+    query_parser.add_argument("-r", "--release")
+    query_parser.add_argument("-s", "--image-serial")
+    query_parser.add_argument("--days", help="Only the last DAYS days", type=int)
+    query_parser.add_argument("--group-by", choices=metadata_fields)
+    query_parser.add_argument(
+        "--boot",
+        help="Boots of the instances: first (with the cloud-init first boot "
+        "work), reboot or all (default: %(default)s)",
+        choices=tuple(boot_kinds),
+        default="all",
+    )
+    query_parser.add_argument(
+        "-p",
+        "--percentiles",
+        help="Comma separated (default: %(default)s)",
+        default="50,95",
+    )
+    args = parser.parse_args()
+
+    db = connect(args.db)
+
+    if args.command == "ingest":
+        ingest(db, args.archives, args.jobs)
+        return
+
+    if args.metric in ("blame", "cloudinit") and not args.unit:
+        parser.error("--unit is required for the %s metric" % args.metric)
+
+    filters = {
+        field: getattr(args, field)
+        for field in ("cloud", "region", "instance_type", "release", "image_serial")
+        if getattr(args, field)
+    }
+    pcts = [float(p) for p in args.percentiles.split(",")]
+    groups = query(
+        db, args.metric, filters, args.days, args.unit, args.group_by, args.boot
+    )
+    if not groups:
+        print("No matching results")
+        sys.exit(1)
+
+    print("\t".join(["group", "n"] + ["p%g" % p for p in pcts]))
+    for key, values in sorted(groups.items()):
+        stats = ["%.1f" % percentile(values, p) for p in pcts]
+        print("\t".join([str(key or "all"), str(len(values))] + stats))
+
+
+if __name__ == "__main__":
+    main()
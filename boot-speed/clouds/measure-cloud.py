@@ -7,20 +7,26 @@ Paride Legovini <paride.legovini@canonical.com>
 """
 
 import argparse
+import asyncio
 import datetime as dt
-import glob
 import json
 import logging
+import math
 import os
 import platform
 import re
 import shutil
+import statistics
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from retrying import retry
 from socket import timeout
@@ -29,6 +35,8 @@ import distro_info
 import paramiko
 import pycloudlib
 
+import bootspeed_analysis
+
 from botocore.exceptions import ClientError
 
 from paramiko.ssh_exception import (
@@ -43,6 +51,105 @@ distro_metanames = ("lts", "stable", "latest", "devel")
 job_timestamp = dt.datetime.utcnow()
 
 
+class Tracer:
+    """
+    Records the time spent in the phases of the measurement job as a
+    Chrome trace (viewable in chrome://tracing or Perfetto), one track per
+    thread. Thread safe.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def complete(self, name, begin_ns, end_ns, tid=None, **args):
+        """
+        Record a span given its start and end time.time_ns(), on the track
+        of thread tid (default: the current thread)
+        """
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": begin_ns / 1000,
+            "dur": (end_ns - begin_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": tid or threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, **args):
+        begin_ns = time.time_ns()
+        try:
+            yield
+        finally:
+            self.complete(name, begin_ns, time.time_ns(), **args)
+
+    def dump(self, path):
+        with self.lock, open(path, "w") as tracefile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, tracefile)
+
+
+tracer = Tracer()
+
+
+class ImageCache:
+    """
+    On-disk cache of the resolved daily images, shared by all the jobs run
+    by the same user on the same machine. Entries are keyed on (cloud,
+    region, release, arch) and expire after `ttl` seconds.
+    """
+
+    def __init__(self, path=None, ttl=3600):
+        if not path:
+            cachedir = os.environ.get("XDG_CACHE_HOME", Path(Path.home(), ".cache"))
+            path = Path(cachedir, "bootspeed", "images.json")
+        self.path = Path(path)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as cachefile:
+                return json.load(cachefile)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self, entries):
+        # Write and rename, so concurrent jobs never see a partial file.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(str(self.path) + "." + str(os.getpid()))
+        with open(tmp_path, "w") as cachefile:
+            json.dump(entries, cachefile, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key, resolve, refresh=False):
+        """
+        Return the cached (image id, serial) for key, calling resolve() to
+        obtain it if missing, expired or if refresh is True.
+        """
+        entry_key = "/".join(key)
+        with self.lock:
+            entry = self.load().get(entry_key)
+        if entry and not refresh and time.time() - entry["resolved"] < self.ttl:
+            print("Using cached image resolution for", entry_key)
+            return entry["image_id"], entry["serial"]
+
+        image_id, serial = resolve()
+        with self.lock:
+            entries = self.load()
+            entries[entry_key] = {
+                "image_id": image_id,
+                "serial": serial,
+                "resolved": time.time(),
+            }
+            self.save(entries)
+
+        return image_id, serial
+
+
 class EC2Instspec:
     cloud = "ec2"
 
@@ -58,7 +165,8 @@ class EC2Instspec:
         ec2_availability_zone,
         ssh_pubkey_path,
         ssh_privkey_path,
-        ssh_keypair_name
+        ssh_keypair_name,
+        image_cache
     ):
         # Defaults. They can't be set as keyword argument defaults because
         # we're always passing all the arguments to __init__, even if they
@@ -73,6 +181,7 @@ class EC2Instspec:
         self.ssh_pubkey_path = ssh_pubkey_path
         self.ssh_privkey_path = ssh_privkey_path
         self.ssh_keypair_name = ssh_keypair_name
+        self.image_cache = image_cache
 
         # User-specified settings
         self.release = release
@@ -118,20 +227,51 @@ class EC2Instspec:
 
         return ami, serial
 
-    def measure(self, datadir, instances=1, reboots=1):
+    def instance_arch(self, ec2):
+        # Will also catch unknown inst types raising a meaningful exception
+        inst_specs = ec2.client.describe_instance_types(InstanceTypes=[self.inst_type])[
+            "InstanceTypes"
+        ][0]
+
+        arch = inst_specs["ProcessorInfo"]["SupportedArchitectures"][0]
+        if arch == "i386":
+            arch = "x86_64"
+
+        return arch
+
+    def resolve_image(self, ec2, release, arch, refresh=False):
+        """Returns the daily image id and serial, from the cache if fresh"""
+
+        def resolve():
+            if release.startswith("debian-"):
+                debrelease = re.search(r"debian-(.*)", release).group(1)
+                if debrelease == "sid":
+                    return self.debian_sid_daily_image(arch)
+                raise NotImplementedError
+
+            daily = ec2.daily_image(release=release, arch=arch)
+            return daily, ec2.image_serial(daily)
+
+        key = (self.cloud, self.region, release, arch)
+        return self.image_cache.get(key, resolve, refresh)
+
+    def warm_image_cache(self):
+        release = resolve_release(self.release)
+        ec2 = pycloudlib.EC2(tag=self.name, region=self.region)
+        self.resolve_image(ec2, release, self.instance_arch(ec2), refresh=True)
+
+    def measure(
+        self, datadir, archive, instances=1, reboots=1, parallel=1, stopper=None
+    ):
         """
         Measure Amazon AWS EC2.
         Returns the measurement metadata as a dictionary
         """
         print("Perforforming measurement on Amazon EC2")
 
-        if self.release in distro_metanames:
-            release = metaname2release(self.release)
-            print("Resolved %s to %s" % (self.release, release))
-        else:
-            release = self.release
-
-        ec2 = pycloudlib.EC2(tag=self.name, region=self.region)
+        with tracer.span("cloud setup"):
+            release = resolve_release(self.release)
+            ec2 = pycloudlib.EC2(tag=self.name, region=self.region)
 
         if not self.ssh_pubkey_path:
             self.ssh_pubkey_path = ec2.key_pair.public_key_path
@@ -141,59 +281,69 @@ class EC2Instspec:
             self.ssh_keypair_name = ec2.key_pair.name
         ec2.use_key(self.ssh_pubkey_path, self.ssh_privkey_path, self.ssh_keypair_name)
 
-        # Will also catch unknown inst types raising a meaningful exception
-        inst_specs = ec2.client.describe_instance_types(InstanceTypes=[self.inst_type])[
-            "InstanceTypes"
-        ][0]
-
-        arch = inst_specs["ProcessorInfo"]["SupportedArchitectures"][0]
-        if arch == "i386":
-            arch = "x86_64"
+        with tracer.span("image lookup"):
+            arch = self.instance_arch(ec2)
+            daily, serial = self.resolve_image(ec2, release, arch)
 
         image_username = "ubuntu"
-
         if release.startswith("debian-"):
             image_username = "admin"
-            debrelease = re.search(r"debian-(.*)", release).group(1)
-            if debrelease == "sid":
-                daily, serial = self.debian_sid_daily_image(arch)
-            else:
-                raise NotImplementedError
-        else:
-            daily = ec2.daily_image(release=release, arch=arch)
-            serial = ec2.image_serial(daily)
 
         print("Instance architecture:", arch)
         print("Daily image for", release, "is", daily)
         print("Image serial:", serial)
         print("Instance username:", image_username)
 
-        for ninstance in range(instances):
-            instance_data = Path(datadir, "instance_" + str(ninstance))
-            instance_data.mkdir()
+        # Launches are serialized so that the availability zone picked for
+        # the first instance can be pinned before the next one is launched.
+        launch_lock = threading.Lock()
 
-            print("Launching instance", ninstance + 1, "of", instances, "tag:", ec2.tag)
-            instance = ec2.launch(
-                image_id=daily,
-                instance_type=self.inst_type,
-                SubnetId=self.subnetid,
-                SecurityGroupIds=self.sgid,
-                Placement={"AvailabilityZone": self.availability_zone},
-                wait=False,
-            )
-            instance.username = image_username
+        # boto3 resources are not thread safe: every worker thread gets its
+        # own pycloudlib.EC2, hence its own boto3 session.
+        local = threading.local()
+        local.ec2 = ec2
 
-            try:
-                measure_instance(instance, instance_data, reboots)
+        def thread_ec2():
+            if not hasattr(local, "ec2"):
+                local.ec2 = pycloudlib.EC2(tag=self.name, region=self.region)
+                local.ec2.use_key(
+                    self.ssh_pubkey_path, self.ssh_privkey_path, self.ssh_keypair_name
+                )
+            return local.ec2
+
+        def measure_one(ninstance):
+            instance_data = Path(datadir, "instance_" + str(ninstance))
+            instance_data.mkdir()
+            ec2 = thread_ec2()
+
+            with launch_lock:
+                print("Launching instance", ninstance + 1, "of", instances, end=" ")
+                print("tag:", ec2.tag)
+                with tracer.span("launch", instance=ninstance):
+                    instance = ec2.launch(
+                        image_id=daily,
+                        instance_type=self.inst_type,
+                        SubnetId=self.subnetid,
+                        SecurityGroupIds=self.sgid,
+                        Placement={"AvailabilityZone": self.availability_zone},
+                        wait=False,
+                    )
+                instance.username = image_username
 
                 # If the availability zone is not specified a random one is
                 # assigned. We want to make sure the next instances (if any)
                 # will use the same zone, so we save it.
                 if not self.availability_zone:
                     self.availability_zone = instance.availability_zone
+
+            try:
+                measure_instance(instance, instance_data, archive, reboots, stopper)
             finally:
                 print("Deleting the instance.")
-                instance.delete(wait=False)
+                with tracer.span("delete", instance=ninstance):
+                    instance.delete(wait=False)
+
+        run_instances(measure_one, instances, parallel, stopper)
 
         metadata = gen_metadata(
             cloud=self.cloud,
@@ -212,12 +362,22 @@ class LXDInstspec:
     cloud = "lxd"
     is_vm = False
 
-    def __init__(self, *, name, release, inst_type, ssh_pubkey_path, ssh_privkey_path):
+    def __init__(
+        self,
+        *,
+        name,
+        release,
+        inst_type,
+        ssh_pubkey_path,
+        ssh_privkey_path,
+        image_cache
+    ):
         self.name = name
         self.inst_type = inst_type
         self.release = release
         self.ssh_pubkey_path = ssh_pubkey_path
         self.ssh_privkey_path = ssh_privkey_path
+        self.image_cache = image_cache
 
         if name:
             self.name = name
@@ -226,29 +386,44 @@ class LXDInstspec:
                 ["bootspeed", self.cloud, self.inst_type.replace(".", ""), self.release]
             )
 
-    def measure(self, datadir, instances=1, reboots=1):
+    def lxd_cloud(self):
+        if self.is_vm:
+            return pycloudlib.LXDVirtualMachine(tag=self.name, timestamp_suffix=False)
+
+        return pycloudlib.LXDContainer(tag=self.name, timestamp_suffix=False)
+
+    def resolve_image(self, lxd, release, refresh=False):
+        """Returns the daily image id and serial, from the cache if fresh"""
+
+        def resolve():
+            image = lxd.daily_image(release=release)
+            return image, lxd.image_serial(image)
+
+        # Images are resolved on the local LXD daemon: no region.
+        key = (self.cloud, "", release, platform.machine())
+        return self.image_cache.get(key, resolve, refresh)
+
+    def warm_image_cache(self):
+        release = resolve_release(self.release)
+        self.resolve_image(self.lxd_cloud(), release, refresh=True)
+
+    def measure(
+        self, datadir, archive, instances=1, reboots=1, parallel=1, stopper=None
+    ):
         """
         Measure LXD containers.
         Returns the measurement metadata as a dictionary
         """
         print("Perforforming measurement on LXD")
 
-        if self.release in distro_metanames:
-            release = metaname2release(self.release)
-            print("Resolved %s to %s" % (self.release, release))
-        else:
-            release = self.release
-
-        if self.is_vm:
-            lxd = pycloudlib.LXDVirtualMachine(tag=self.name, timestamp_suffix=False)
-        else:
-            lxd = pycloudlib.LXDContainer(tag=self.name, timestamp_suffix=False)
-
-        lxd.key_pair = pycloudlib.key.KeyPair(
-            self.ssh_pubkey_path, self.ssh_privkey_path
-        )
-        image = lxd.daily_image(release=release)
-        serial = lxd.image_serial(image)
+        with tracer.span("cloud setup"):
+            release = resolve_release(self.release)
+            lxd = self.lxd_cloud()
+            lxd.key_pair = pycloudlib.key.KeyPair(
+                self.ssh_pubkey_path, self.ssh_privkey_path
+            )
+        with tracer.span("image lookup"):
+            image, serial = self.resolve_image(lxd, release)
 
         print("Daily image for", release, "is", image)
         print("Image serial:", serial)
@@ -257,24 +432,33 @@ class LXDInstspec:
         def retry_delete(instance):
             instance.delete()
 
-        for ninstance in range(instances):
+        def measure_one(ninstance):
             instance_data = Path(datadir, "instance_" + str(ninstance))
             instance_data.mkdir()
 
+            # Instances running at the same time need distinct names.
+            name = self.name
+            if parallel > 1:
+                name += "-" + str(ninstance)
+
             print("Launching instance", ninstance + 1, "of", instances)
-            instance = lxd.launch(
-                image_id=image,
-                instance_type=self.inst_type,
-                name=self.name,
-                ephemeral=True,
-            )
-            print("Instance launched (%s)" % self.name)
+            with tracer.span("launch", instance=ninstance):
+                instance = lxd.launch(
+                    image_id=image,
+                    instance_type=self.inst_type,
+                    name=name,
+                    ephemeral=True,
+                )
+            print("Instance launched (%s)" % name)
 
             try:
-                measure_instance(instance, instance_data, reboots)
+                measure_instance(instance, instance_data, archive, reboots, stopper)
             finally:
                 print("Deleting the instance.")
-                retry_delete(instance)
+                with tracer.span("delete", instance=ninstance):
+                    retry_delete(instance)
+
+        run_instances(measure_one, instances, parallel, stopper)
 
         # On LXD we can consider the machine the measurement is run on as the
         # 'region'; platform.node() returns its hostname.
@@ -296,102 +480,443 @@ class KVMInstspec(LXDInstspec):
     is_vm = True
 
 
-def ssh_hammer(instance):
-    # Hammer the instance via SSH to record the first SSH login time.
-    print("SSH-hammering instance")
+def run_instances(measure_one, instances, parallel=1, stopper=None):
+    """
+    Call measure_one(ninstance) for every instance, running up to `parallel`
+    of them at the same time. After the first failure no further instance
+    is started, as in the serial case; that failure is re-raised once the
+    running workers are done, so every launched instance gets deleted.
+    Instances not started yet are also skipped once the stopper (EarlyStop)
+    is done.
+    """
+    failed = threading.Event()
+
+    def measure_unless_done(ninstance):
+        if failed.is_set():
+            print("An instance failed, skipping instance", ninstance + 1)
+            return
+        if stopper and stopper.done():
+            print("Target confidence reached, skipping instance", ninstance + 1)
+            return
+        try:
+            measure_one(ninstance)
+        except BaseException:
+            # measure_boot() fails with sys.exit(), hence BaseException.
+            failed.set()
+            raise
+
+    if parallel <= 1:
+        for ninstance in range(instances):
+            measure_unless_done(ninstance)
+        return
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(measure_unless_done, n) for n in range(instances)]
+
+    for future in futures:
+        future.result()
+
+
+def rfc3339_ns(timestamp_ns):
+    """Format a time.time_ns() value as `date --utc --rfc-3339=ns` does"""
+    secs, nsecs = divmod(timestamp_ns, 10**9)
+    date = dt.datetime.fromtimestamp(secs, dt.timezone.utc)
+    return date.strftime("%Y-%m-%d %H:%M:%S") + ".%09d+00:00" % nsecs
+
+
+def ssh_login(instance, hostname, private_key):
+    """Try to log in and run a command once. Returns True on success."""
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            username=instance.username,
+            hostname=hostname,
+            pkey=private_key,
+            timeout=1,
+            banner_timeout=1,
+            auth_timeout=1,
+        )
+        client.exec_command("true")
+    except (
+        timeout,
+        AuthenticationException,
+        SSHException,
+        EOFError,
+        NoValidConnectionsError,
+        ConnectionResetError,
+    ):
+        return False
+    finally:
+        client.close()
+
+    return True
+
+
+async def ssh_wait_ready(
+    instance, datadir, prefix="", port=22, timeout_delta=900, tid=None
+):
+    """
+    Wait for the instance to accept SSH logins, going through three stages:
+    TCP connect, SSH banner received and first successful login. The time
+    at which each stage was first reached is written to datadir as
+    <prefix>ssh-<stage>-timestamp, in the format of job-start-timestamp.
+    The stages are traced on the track of thread tid.
+
+    Only the IP lookup and the login attempt are blocking (pycloudlib,
+    paramiko) and they run in the default executor, so several instances
+    can be watched from the same event loop (see ssh_hammer). The IP is
+    looked up every ip_interval until known: for EC2 it is an API call.
+    """
+    loop = asyncio.get_running_loop()
     private_key = paramiko.RSAKey.from_private_key_file(
         instance.key_pair.private_key_path
     )
+    ip_interval = 0.5
+    probe_interval = 0.05
+    probe_timeout = 1
+    stamps = {}
+    # Not saved as a stamp file, only used to trace the wait for the IP.
+    start = time.time_ns()
+    ip_found = None
+
+    async def get_ip():
+        try:
+            return await loop.run_in_executor(None, lambda: instance.ip)
+        except ClientError:
+            return None
 
-    timeout_start = time.time()
-    # Let's be patient here: metal instances are slow to start.
-    timeout_delta = 900
+    async def probe_banner(instip):
+        """Returns the first line sent by the server, b"" on failure."""
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(instip, port), probe_timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            return b""
 
-    while time.time() < timeout_start + timeout_delta:
-        instip = instance.ip
-        if not instip:
-            time.sleep(0.5)
-            continue
+        stamps.setdefault("tcp", time.time_ns())
+        try:
+            return await asyncio.wait_for(reader.readline(), probe_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return b""
+        finally:
+            writer.close()
+
+    async def probe():
+        nonlocal ip_found
+        instip = None
+        while not instip:
+            instip = await get_ip()
+            if not instip:
+                await asyncio.sleep(ip_interval)
+        ip_found = time.time_ns()
+        while True:
+            if (await probe_banner(instip)).startswith(b"SSH-"):
+                stamps.setdefault("banner", time.time_ns())
+                if await loop.run_in_executor(
+                    None, ssh_login, instance, instip, private_key
+                ):
+                    stamps["login"] = time.time_ns()
+                    return
+            await asyncio.sleep(probe_interval)
+
+    try:
+        await asyncio.wait_for(probe(), timeout_delta)
+    except asyncio.TimeoutError:
+        raise TimeoutError("timeout while hammering SSH") from None
+    finally:
+        for stage, stamp in stamps.items():
+            stampfile = Path(datadir, prefix + "ssh-" + stage + "-timestamp")
+            stampfile.write_text(rfc3339_ns(stamp) + "\n")
+
+        previous = start
+        for phase, stamp in (("ip", ip_found),) + tuple(stamps.items()):
+            if stamp:
+                tracer.complete("wait for " + phase, previous, stamp, tid=tid)
+                previous = stamp
+
+
+ssh_loop = None
+ssh_loop_lock = threading.Lock()
+
+
+def get_ssh_loop():
+    """
+    The event loop watching the SSH readiness of all the instances, running
+    in a daemon thread, started on first use
+    """
+    global ssh_loop
+    with ssh_loop_lock:
+        if ssh_loop is None:
+            ssh_loop = asyncio.new_event_loop()
+            threading.Thread(target=ssh_loop.run_forever, daemon=True).start()
+    return ssh_loop
+
+
+def ssh_hammer(instance, datadir, prefix=""):
+    # Hammer the instance via SSH to record the first SSH login time.
+    print("SSH-hammering instance")
+    # Let's be patient here: metal instances are slow to start.
+    with tracer.span("ssh_hammer"):
+        wait = ssh_wait_ready(
+            instance, datadir, prefix, timeout_delta=900, tid=threading.get_ident()
+        )
+        asyncio.run_coroutine_threadsafe(wait, get_ssh_loop()).result()
+
+
+class SSHSession:
+    """
+    A single SSH connection to an instance. All the commands and file
+    transfers of a boot go over the same transport, so they don't pay (and
+    add the jitter of) a new connection setup each. The session does not
+    survive a reboot: close() it before restarting the instance and
+    connect() again once SSH is back.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.client = None
+
+    def connect(self):
+        self.close()
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(
+            username=self.instance.username,
+            hostname=self.instance.ip,
+            key_filename=self.instance.key_pair.private_key_path,
+            timeout=30,
+        )
+        self.client.get_transport().set_keepalive(30)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def execute(self, command):
+        """Run command, return its stdout without the trailing newline"""
+        _, stdout, _ = self.client.exec_command(command)
+        out = stdout.read().decode("utf-8", "replace")
+        stdout.channel.recv_exit_status()
+        return out.rstrip("\n")
+
+    def stream(self, command):
+        """Run command, return a file-like object reading its stdout"""
+        _, stdout, _ = self.client.exec_command(command)
+        return stdout
+
+
+class ArchiveWriter:
+    """
+    Streaming writer for the final measurement archive. The tar streams
+    produced on the instances are copied into it member by member, so the
+    artifacts are not compressed twice. Safe to share between the threads
+    measuring concurrent instances: with spool, each stream is first
+    spooled to a temporary file, so that only the (local) copy into the
+    archive is serialized, not the transfers. Without it (a single
+    instance at a time) the streams go straight into the archive.
+    """
+
+    formats = {"gz": ".tar.gz", "zst": ".tar.zst"}
+
+    def __init__(self, archivename, fmt="gz", spool=False):
+        self.archivename = archivename
+        self.spool = spool
+        self.path = archivename + self.formats[fmt]
+        self.partial_path = self.path + ".part"
+        self.lock = threading.Lock()
+        self.compressor = None
+
+        if fmt == "zst":
+            try:
+                import zstandard
+            except ImportError as exc:
+                raise RuntimeError(
+                    "zstd archives need zstandard: sudo apt install python3-zstandard"
+                ) from exc
 
+        self.fileobj = open(self.partial_path, "wb")
         try:
-            client.connect(
-                username=instance.username,
-                hostname=instip,
-                pkey=private_key,
-                timeout=1,
-                banner_timeout=1,
-                auth_timeout=1,
-            )
-            client.exec_command("true")
-        except (
-            timeout,
-            AuthenticationException,
-            SSHException,
-            EOFError,
-            NoValidConnectionsError,
-            ConnectionResetError,
-            ClientError,
-        ):
-            pass
-        else:
-            client.close()
+            if fmt == "zst":
+                self.compressor = zstandard.ZstdCompressor().stream_writer(self.fileobj)
+                self.tar = tarfile.open(fileobj=self.compressor, mode="w|")
+            else:
+                self.tar = tarfile.open(fileobj=self.fileobj, mode="w|gz")
+        except BaseException:
+            self.fileobj.close()
+            os.remove(self.partial_path)
+            raise
+
+    def add_tar_stream(self, stream, prefix):
+        """Copy all the members of a tar stream under archivename/prefix"""
+        if not self.spool:
+            with self.lock:
+                self._copy_members(stream, prefix)
+            return
+        with tempfile.TemporaryFile(dir=os.path.dirname(self.path) or ".") as spool:
+            shutil.copyfileobj(stream, spool, 1 << 20)
+            spool.seek(0)
+            with self.lock:
+                self._copy_members(spool, prefix)
+
+    def _copy_members(self, fileobj, prefix):
+        with tarfile.open(fileobj=fileobj, mode="r|") as src:
+            for member in src:
+                name = os.path.normpath(member.name).lstrip("/")
+                member.name = os.path.normpath(
+                    os.path.join(self.archivename, prefix, name)
+                )
+                data = src.extractfile(member) if member.isfile() else None
+                self.tar.addfile(member, data)
+
+    def add(self, path):
+        """Add a local directory as the archive top-level directory"""
+        with self.lock:
+            self.tar.add(path, arcname=self.archivename)
+
+    def close(self, complete=True):
+        """
+        Finalize the archive, renaming it in place if complete, else (or
+        on error) removing it
+        """
+        done = False
+        try:
+            self.tar.close()
+            if self.compressor:
+                self.compressor.close()
+            done = complete
+        finally:
+            self.fileobj.close()
+            if done:
+                os.rename(self.partial_path, self.path)
+            else:
+                os.remove(self.partial_path)
+
+
+class EarlyStop:
+    """
+    Adaptive measurement budget: tells when the 95% confidence interval of
+    the mean of a boot metric (as reported by `systemd-analyze time`) got
+    narrower than ci_width milliseconds. Shared between the instances
+    measured concurrently. Only reboots are sampled: the first boot of an
+    instance also runs the cloud-init first boot work, its timings are from
+    another distribution.
+    """
+
+    # Two-sided 95% Student's t quantiles, by degrees of freedom (1-30).
+    # fmt: off
+    t95 = (
+        12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+    )
+    # fmt: on
+    min_samples = 3
+
+    def __init__(self, metric, ci_width):
+        self.metric = metric
+        self.ci_width = ci_width
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def ci(self):
+        """Returns the width of the confidence interval, inf if unknown"""
+        nsamples = len(self.samples)
+        if nsamples < 2:
+            return math.inf
+        dof = nsamples - 1
+        tquant = self.t95[dof - 1] if dof <= len(self.t95) else 1.96
+        return 2 * tquant * statistics.stdev(self.samples) / math.sqrt(nsamples)
+
+    def add(self, analyze_time, nboot):
+        """Add a sample from the output of `systemd-analyze time` of boot nboot"""
+        if nboot == 0:
             return
+        value = bootspeed_analysis.parse_analyze_time(analyze_time)[self.metric]
+        if value is None:
+            print("No %s time in systemd-analyze time output" % self.metric)
+            return
+        with self.lock:
+            self.samples.append(value)
+            print(
+                "%s time: %.1f ms, 95%% CI width after %d reboots: %.1f ms "
+                "(target %.1f)"
+                % (self.metric, value, len(self.samples), self.ci(), self.ci_width)
+            )
+
+    def done(self):
+        with self.lock:
+            return len(self.samples) >= self.min_samples and self.ci() <= self.ci_width
+
+
+def measure_boot(session, datadir, archive, nboot, stopper=None):
+    """Run bootspeed.sh over session and stream its artifacts to archive"""
+    with tracer.span("bootspeed.sh", boot=nboot):
+        outstr = session.execute("./bootspeed.sh 2>&1")
+    print(outstr)
+    outstr = session.execute("find artifacts")
+    print("----- remote listing")
+    print(outstr)
+    print("----- end of remote listing")
+
+    # Test for the existence of the file bootspeed.sh creates if it
+    # reached the end of the measurement with no errors.
+    outstr = session.execute("test -f artifacts/measurement-successful && echo ok")
+    if outstr == "ok":
+        print("artifacts/measurement-successful present => SUCCESS")
+    else:
+        print("Measurement failed (missing measurement-successful)!")
+        sys.exit(1)
+
+    if stopper:
+        stopper.add(session.execute("cat artifacts/systemd-analyze_time"), nboot)
 
-    raise TimeoutError("timeout while hammering SSH")
+    bootdir = "boot_" + str(nboot)
+    print("Stream the measurement data into the archive")
+    # Uncompressed: the archive writer does the (only) compression.
+    with tracer.span("artifact transfer", boot=nboot):
+        stdout = session.stream("tar -C artifacts -cf - .")
+        archive.add_tar_stream(stdout, os.path.join(Path(datadir).name, bootdir))
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError("failed to stream the artifacts of " + bootdir)
 
 
-def measure_instance(instance, datadir, reboots=1):
+def measure_instance(instance, datadir, archive, reboots=1, stopper=None):
     print("*** Measuring instance ***")
 
     # Use the same command (and hence format) used when measuring devices
     os.system("date --utc --rfc-3339=ns > " + str(Path(datadir, "job-start-timestamp")))
 
-    ssh_hammer(instance)
+    ssh_hammer(instance, datadir)
+    session = SSHSession(instance)
 
-    instance.execute(
-        "wget https://raw.githubusercontent.com/canonical/"
-        "server-test-scripts/master/boot-speed/bootspeed.sh"
-    )
-    instance.execute("chmod +x bootspeed.sh")
-
-    for nboot in range(0, reboots + 1):
-        print("Measuring boot %d" % nboot)
-
-        if nboot > 0:
-            instance.restart(wait=True)
-            ssh_hammer(instance)
-
-        outstr = instance.execute("./bootspeed.sh 2>&1")
-        print(outstr)
-        outstr = instance.execute("find artifacts")
-        print("----- remote listing")
-        print(outstr)
-        print("----- end of remote listing")
-
-        # Test for the existence of the file bootspeed.sh creates if it
-        # reached the end of the measurement with no errors.
-        outstr = instance.execute(
-            "test -f artifacts/measurement-successful" " && echo ok"
-        )
-        if outstr == "ok":
-            print("artifacts/measurement-successful present => SUCCESS")
-        else:
-            print("Measurement failed (missing measurement-successful)!")
-            sys.exit(1)
+    try:
+        with tracer.span("setup"):
+            session.connect()
+            session.execute(
+                "wget https://raw.githubusercontent.com/canonical/"
+                "server-test-scripts/master/boot-speed/bootspeed.sh"
+            )
+            session.execute("chmod +x bootspeed.sh")
+
+        for nboot in range(0, reboots + 1):
+            print("Measuring boot %d" % nboot)
 
-        bootdir = "boot_" + str(nboot)
-        print("Prepare the measurement data tarball")
-        instance.execute("mv artifacts " + bootdir)
-        instance.execute("tar czf " + bootdir + ".tar.gz " + bootdir)
-        print("Pull the tarball")
-        instance.pull_file(bootdir + ".tar.gz", bootdir + ".tar.gz")
+            if nboot > 0:
+                if stopper and stopper.done():
+                    print("Target confidence reached, no more reboots")
+                    break
+                session.close()
+                with tracer.span("restart", boot=nboot):
+                    instance.restart(wait=True)
+                ssh_hammer(instance, datadir, "boot_%d-" % nboot)
+                session.connect()
 
-    for tarball in glob.glob("boot_*.tar.gz"):
-        with tarfile.open(tarball, "r:gz") as tar:
-            tar.extractall(path=datadir)
-        os.unlink(tarball)
+            measure_boot(session, datadir, archive, nboot, stopper)
+    finally:
+        session.close()
 
 
 def gen_metadata(
@@ -429,6 +954,16 @@ def gen_archivename(metadata):
     return arcname
 
 
+def resolve_release(release):
+    if release in distro_metanames:
+        resolved = metaname2release(release)
+        print("Resolved %s to %s" % (release, resolved))
+        return resolved
+
+    return release
+
+
+@lru_cache(maxsize=None)
 def metaname2release(metaname):
     if metaname == "latest":
         # 'all' is a list of codenames of all known releases, including
@@ -438,13 +973,7 @@ def metaname2release(metaname):
     return getattr(distro_info.UbuntuDistroInfo(), metaname)()
 
 
-def main():
-    args = parse_args()
-
-    if args.cloud not in known_clouds:
-        print("Unknown cloud provider:", args.cloud)
-        sys.exit(1)
-
+def make_instspec(args, image_cache):
     if args.cloud == "ec2":
         instspec = EC2Instspec(
             name=args.name,
@@ -457,6 +986,7 @@ def main():
             ssh_pubkey_path=args.ssh_pubkey_path,
             ssh_privkey_path=args.ssh_privkey_path,
             ssh_keypair_name=args.ssh_keypair_name,
+            image_cache=image_cache,
         )
     elif args.cloud == "lxd":
         instspec = LXDInstspec(
@@ -465,6 +995,7 @@ def main():
             inst_type=args.inst_type,
             ssh_pubkey_path=args.ssh_pubkey_path,
             ssh_privkey_path=args.ssh_privkey_path,
+            image_cache=image_cache,
         )
     elif args.cloud == "kvm":
         instspec = KVMInstspec(
@@ -473,37 +1004,130 @@ def main():
             inst_type=args.inst_type,
             ssh_pubkey_path=args.ssh_pubkey_path,
             ssh_privkey_path=args.ssh_privkey_path,
+            image_cache=image_cache,
         )
     else:
         raise NotImplementedError
 
+    return instspec
+
+
+def warm_image_cache(args, image_cache):
+    """
+    Resolve the daily images of a whole job matrix in one go, refreshing
+    the image cache. The matrix is a JSON list of objects whose keys are
+    the command line option names, e.g.
+    [{"cloud": "ec2", "release": "jammy", "inst_type": "t3.micro"}, ...]
+    Options not set in an entry are taken from the command line.
+    """
+    with open(args.warm_image_cache) as matrixfile:
+        matrix = json.load(matrixfile)
+
+    instspecs = []
+    for job in matrix:
+        job_args = argparse.Namespace(**vars(args))
+        for option, value in job.items():
+            setattr(job_args, option, value)
+        instspecs.append(make_instspec(job_args, image_cache))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(i.warm_image_cache) for i in instspecs]
+
+    for future in futures:
+        future.result()
+
+
+def main():
+    args = parse_args()
+    image_cache = ImageCache(ttl=args.image_cache_ttl)
+
+    if args.warm_image_cache:
+        warm_image_cache(args, image_cache)
+        return
+
+    if args.cloud not in known_clouds:
+        print("Unknown cloud provider:", args.cloud)
+        sys.exit(1)
+
+    instspec = make_instspec(args, image_cache)
+
     tmp_datadir = tempfile.mkdtemp(prefix="bootspeed-", dir=os.getcwd())
 
+    # The boot artifacts are streamed into the archive as they are
+    # collected, so its name is needed upfront. It does not depend on the
+    # image details that are only known after the measurement.
+    archivename = gen_archivename(
+        gen_metadata(
+            cloud=instspec.cloud,
+            region="",
+            inst_type=instspec.inst_type,
+            release=instspec.release,
+            cloudid="",
+            serial="",
+        )
+    )
+    archive = ArchiveWriter(
+        archivename,
+        args.archive_format,
+        spool=args.parallel > 1 and args.instances > 1,
+    )
+
+    stopper = None
+    if args.ci_width:
+        stopper = EarlyStop(args.ci_metric, args.ci_width)
+
     logging.basicConfig(level=logging.INFO)
-    metadata = instspec.measure(tmp_datadir, args.instances, args.reboots)
+    try:
+        metadata = instspec.measure(
+            tmp_datadir,
+            archive,
+            args.instances,
+            args.reboots,
+            args.parallel,
+            stopper,
+        )
 
-    with open(Path(tmp_datadir, "metadata.json"), "w") as mdfile:
-        json.dump(metadata, mdfile)
+        with open(Path(tmp_datadir, "metadata.json"), "w") as mdfile:
+            json.dump(metadata, mdfile)
+        tracer.dump(Path(tmp_datadir, "trace.json"))
 
-    archivename = gen_archivename(metadata)
-    with tarfile.open((archivename + ".tar.gz"), "w:gz") as tar:
-        tar.add(tmp_datadir, arcname=archivename)
+        archive.add(tmp_datadir)
+    except BaseException:
+        archive.close(complete=False)
+        raise
 
+    archive.close()
     shutil.rmtree(tmp_datadir)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--name", help="Instance name", default=None)
+    parser.add_argument("-c", "--cloud", help="Cloud to measure", choices=known_clouds)
+    parser.add_argument("-t", "--inst-type", help="Instance type", default="t2.micro")
+    parser.add_argument("-r", "--release", help="Ubuntu release to measure")
+    parser.add_argument("--reboots", help="Number of reboots", default=1, type=int)
+    parser.add_argument("--instances", help="Number of instances", default=1, type=int)
     parser.add_argument(
-        "-c", "--cloud", help="Cloud to measure", choices=known_clouds, required=True
+        "--parallel",
+        help="Number of instances to measure concurrently",
+        default=1,
+        type=int,
     )
-    parser.add_argument("-t", "--inst-type", help="Instance type", default="t2.micro")
     parser.add_argument(
-        "-r", "--release", help="Ubuntu release to measure", required=True
+        "--ci-width",
+        help="Adaptive mode: stop measuring once the 95%% confidence interval "
+        "of the mean of --ci-metric over the reboots (first boots are not "
+        "sampled) is narrower than CI_WIDTH ms; --instances and --reboots "
+        "become the maximum budget",
+        type=float,
+    )
+    parser.add_argument(
+        "--ci-metric",
+        help="Boot metric used in adaptive mode (default: %(default)s)",
+        choices=bootspeed_analysis.boot_splits + ("total",),
+        default="userspace",
     )
-    parser.add_argument("--reboots", help="Number of reboots", default=1, type=int)
-    parser.add_argument("--instances", help="Number of instances", default=1, type=int)
     parser.add_argument(
         "--ssh-pubkey-path",
         help="Override pycloudlib's " "default for the SSH public key to use",
@@ -527,7 +1151,29 @@ def parse_args():
         "--ec2-sgid", help="AWS EC2 SecurityGroupId", action="append", default=[]
     )
     parser.add_argument("--region", help="Cloud region")
+    parser.add_argument(
+        "--archive-format",
+        help="Compression of the result archive",
+        choices=ArchiveWriter.formats,
+        default="gz",
+    )
+    parser.add_argument(
+        "--image-cache-ttl",
+        help="Seconds a cached daily image resolution stays valid",
+        default=3600,
+        type=int,
+    )
+    parser.add_argument(
+        "--warm-image-cache",
+        metavar="MATRIX",
+        help="Resolve the images of all the jobs in the MATRIX JSON file, "
+        "refreshing the image cache, and exit",
+    )
     args = parser.parse_args()
+
+    if not args.warm_image_cache and not (args.cloud and args.release):
+        parser.error("the following arguments are required: -c/--cloud, -r/--release")
+
     return args
 
 
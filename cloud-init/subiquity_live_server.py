@@ -5,27 +5,38 @@ Test live server and live desktop ISO integration with cloud-init user-data
 
 
 Test procedure:
-1. Check latest live server or desktop manfist
-2. If manifest differs from locally cached manifest file, download new ISO
+1. Check the SHA256 of the latest live server or desktop ISO
+2. If the ISO cache has no entry for this SHA256, download the new ISO
 3. Create a passwordless ssh rsa key: ci_test_kvm_key
 4. In a tmpdir: create cloud_localds seed iso with autoinstall user data
 5. Create a QEMU target disk to represent the target VM harddrive
 6. Launch QEMU KVM with seed.iso and disk providing 'autoinstall' kernel param
 7. Once installed system powers down, relaunch the target disk and expose ssh
-   on an open port >= 2222
+   on an open port >= 2222, and wait until its sshd is up, watching its
+   QMP events and serial console for a failed boot (see VMMonitor)
 8. Use ssh andkey from step 3 to validate both ephemeral boot and firt boot
    runs of cloud-init via log scrapes and cloud-init status.
 
+With --save-golden, the disk installed by step 6 is saved as a qcow2 golden
+image, keyed by ISO and user-data, once step 8 passed (step 7 boots it through
+a qcow2 overlay). With --from-golden, steps 5 and 6 are replaced by a qcow2
+overlay of that golden image, when it exists, to only test the first boot.
+
 
 Interim test solution until we grow qemu-kvm support direct in
 https://github.com/canonical/pycloudlib.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import fcntl
 from functools import partial
+import hashlib
 import json
 import logging
 import os
+import random
 import re
 import shutil
 import socket
@@ -37,10 +48,11 @@ import time
 from enum import Enum
 from functools import wraps
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 import yaml
 
 import requests
+from requests.adapters import HTTPAdapter
 
 SSH_PRIVATE_KEY_NAME = "ci_test_kvm_key"
 
@@ -175,21 +187,368 @@ def cloud_localds(
     return img_path
 
 
-def create_qemu_disk(tmpdir: Path, vm_name: str, size: str):
+def create_qemu_disk(
+    tmpdir: Path,
+    vm_name: str,
+    size: str,
+    disk_format: str = "raw",
+    backing: Optional[Path] = None,
+    backing_format: str = "qcow2",
+):
+    """Create a sparse raw disk, or a qcow2 one, optionally an overlay of backing"""
     img_path = tmpdir.joinpath(f"{vm_name}.img")
     if img_path.exists():
         logging.debug("Reusing %s", img_path)
-    else:
+    elif disk_format == "raw":
+        assert backing is None, "raw disks cannot have a backing file"
         subprocess.run(["truncate", "-s", size, img_path])
+    else:
+        cmd = ["qemu-img", "create", "-f", "qcow2"]
+        if backing:
+            cmd += ["-b", str(backing.resolve()), "-F", backing_format]
+        subprocess.run(cmd + [str(img_path), size], check=True)
     return img_path
 
 
+def golden_image_path(iso_path: Path, user_data: str) -> Path:
+    """Returns the path of the installed disk of iso_path with user_data.
+
+    Golden images live next to the ISO, in its cache entry (see IsoCache),
+    and are keyed by the ISO checksum (the entry name) and user-data.
+    """
+    key = hashlib.sha256(f"{iso_path.parent.name}\n{user_data}".encode())
+    return iso_path.with_name(f"{iso_path.stem}.golden-{key.hexdigest()[:16]}.qcow2")
+
+
+def save_golden_image(disk_img_path: Path, disk_format: str, golden_path: Path):
+    """Save a copy of a freshly installed disk as a qcow2 golden image.
+
+    The disk must be as installed: main() boots it through an overlay, and
+    only saves it once that first boot passed.
+    """
+    logging.info(f"Saving installed disk {disk_img_path} to {golden_path}")
+    tmp_path = golden_path.with_name(f"{golden_path.name}.{os.getpid()}.tmp")
+    subprocess.run(
+        ["qemu-img", "convert", "-f", disk_format, "-O", "qcow2"]
+        + [str(disk_img_path), str(tmp_path)],
+        check=True,
+    )
+    os.replace(tmp_path, golden_path)
+
+
+ISO_SEGMENT_SIZE = 64 * 1024 * 1024
+# (connect, read) timeouts of the HTTP requests, so that a stalled
+# connection fails (and is retried) instead of hanging
+ISO_HTTP_TIMEOUT = (10, 60)
+
+
+def iso_session(parts: int = 4) -> requests.Session:
+    """Returns a requests Session with a connection pool for parts workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=parts)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_iso_sha256(
+    session: requests.Session, iso_base_url: str, iso_name: str
+) -> Optional[str]:
+    """Returns the SHA256 of iso_name from SHA256SUMS, None if unavailable."""
+    r = session.get(
+        f"{iso_base_url}SHA256SUMS", allow_redirects=True, timeout=ISO_HTTP_TIMEOUT
+    )
+    if r.status_code != 200:
+        logging.warning(f"No SHA256SUMS for {iso_base_url}: {r.status_code}")
+        return None
+    for line in r.text.splitlines():
+        sha256, _, name = line.partition(" ")
+        if name.lstrip("*") == iso_name:
+            return sha256
+    logging.warning(f"{iso_name} is not listed in {iso_base_url}SHA256SUMS")
+    return None
+
+
+class IsoDownload:
+    """Parallel, resumable download of a large file with HTTP range requests.
+
+    The file is split in segment_size segments, fetched by parts workers
+    over a shared session and written in place to <dest>.part. Completed
+    segments are recorded in the <dest>.part.json sidecar, so that an
+    interrupted download resumes where it stopped (as long as the upstream
+    size and ETag did not change). The SHA256 is computed while writing,
+    over the contiguous prefix of completed segments, and checked against
+    sha256 before the file is renamed to dest.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        dest: Path,
+        sha256: Optional[str] = None,
+        parts: int = 4,
+        segment_size: int = ISO_SEGMENT_SIZE,
+        timeout: Tuple[float, float] = ISO_HTTP_TIMEOUT,
+    ):
+        self.session = session
+        self.url = url
+        self.dest = dest
+        self.sha256 = sha256
+        self.parts = parts
+        self.segment_size = segment_size
+        self.timeout = timeout
+        self.part_path = dest.with_name(dest.name + ".part")
+        self.state_path = dest.with_name(dest.name + ".part.json")
+        self.state_lock = threading.Lock()
+        self.hash_lock = threading.Lock()
+
+    def run(self) -> Path:
+        r = self.session.head(self.url, allow_redirects=True, timeout=self.timeout)
+        r.raise_for_status()
+        self.size = int(r.headers["Content-Length"])
+        self.validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+        self.nsegments = -(-self.size // self.segment_size)
+        self.done = self._load_state()
+        if not self.done:
+            with open(self.part_path, "wb") as stream:
+                stream.truncate(self.size)
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+
+        with open(self.part_path, "r+b") as stream:
+            self.fd = stream.fileno()
+            if r.headers.get("Accept-Ranges") == "bytes" and self.size:
+                todo = [i for i in range(self.nsegments) if i not in self.done]
+                if self.done:
+                    logging.info(
+                        f"Resuming {self.url}: {len(todo)}/{self.nsegments}"
+                        " segments left"
+                    )
+                with ThreadPoolExecutor(max_workers=self.parts) as pool:
+                    # list() to raise the first download error, if any
+                    list(pool.map(self._fetch_segment, todo))
+            else:
+                logging.info(f"{self.url} does not support ranges")
+                self._fetch_all()
+            self._hash_completed()
+
+        digest = self.hasher.hexdigest()
+        if self.sha256 and digest != self.sha256:
+            self.part_path.unlink()
+            self.state_path.unlink(missing_ok=True)
+            raise RuntimeError(
+                f"SHA256 mismatch for {self.url}: {digest} != {self.sha256}"
+            )
+        os.replace(self.part_path, self.dest)
+        self.state_path.unlink(missing_ok=True)
+        self.digest = digest
+        return self.dest
+
+    def _state_header(self) -> dict:
+        return {
+            "url": self.url,
+            "size": self.size,
+            "validator": self.validator,
+            "segment_size": self.segment_size,
+        }
+
+    def _load_state(self) -> set:
+        """Returns the completed segments of a previous matching download."""
+        if not (self.state_path.exists() and self.part_path.exists()):
+            return set()
+        state = json.loads(self.state_path.read_text())
+        if any(state.get(k) != v for k, v in self._state_header().items()):
+            logging.info(f"Upstream {self.url} changed, restarting download")
+            return set()
+        return set(state["done"])
+
+    def _save_state(self):
+        state = dict(self._state_header(), done=sorted(self.done))
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+    @retry(requests.RequestException, [1, 5, 10, 30, 60])
+    def _fetch_segment(self, segment: int):
+        start = segment * self.segment_size
+        end = min(start + self.segment_size, self.size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        with self.session.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout
+        ) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise requests.RequestException(f"Range ignored: {r.status_code}")
+            offset = start
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                os.pwrite(self.fd, chunk, offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise requests.RequestException(f"Short read of segment {segment}")
+
+        with self.state_lock:
+            self.done.add(segment)
+            self._save_state()
+            done = len(self.done)
+        if done * 20 // self.nsegments != (done - 1) * 20 // self.nsegments:
+            print(
+                f"{done * 100 // self.nsegments}%"
+                f" of {self.size/1024/1024/1000:.2f}GB downloaded",
+                flush=True,
+            )
+        self._hash_completed()
+
+    def _hash_completed(self):
+        """Hash the segments completed right after the hashed prefix."""
+        with self.hash_lock:
+            while self.hashed < self.nsegments:
+                with self.state_lock:
+                    if self.hashed not in self.done:
+                        return
+                start = self.hashed * self.segment_size
+                length = min(self.segment_size, self.size - start)
+                # Fresh data: read back from the page cache
+                self.hasher.update(os.pread(self.fd, length, start))
+                self.hashed += 1
+
+    def _fetch_all(self):
+        """Fallback for servers without range support: one stream, no resume."""
+        self.done = set()
+        with self.session.get(self.url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            with open(self.part_path, "wb") as stream:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    stream.write(chunk)
+                    self.hasher.update(chunk)
+        self.hashed = self.nsegments
+
+
+class IsoCache:
+    """Content-addressed cache of ISOs and their manifests, with LRU eviction.
+
+    Entries are <root>/<key>/ directories, key being the upstream SHA256 of
+    the ISO, locked with <root>/<key>.lock. Complete entries are used under a
+    shared lock; an incomplete one is filled under an exclusive lock, so that
+    concurrent jobs wait for a single download. Entries in use are then held
+    with a shared lock until the process exits, and are never evicted:
+    eviction removes the least recently used unlocked entries beyond budget
+    bytes, with their lock file. The <root>/<release>/ directories of the
+    former (manifest md5sum) layout count as entries too, so that they are
+    evicted first rather than left out of the budget.
+    """
+
+    def __init__(self, root: Path, budget: int):
+        self.root = root
+        self.budget = budget
+        self.held = {}
+        root.mkdir(parents=True, exist_ok=True)
+
+    def _lock(self, key: str, operation: int) -> int:
+        """Open and flock <key>.lock, again if evict removed it meanwhile."""
+        lock_path = self.root.joinpath(f"{key}.lock")
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, operation)
+            except BaseException:
+                os.close(fd)
+                raise
+            if self._current(fd, key):
+                return fd
+            os.close(fd)
+
+    def _current(self, fd: int, key: str) -> bool:
+        """Check that fd still is the lock file of key."""
+        lock_path = self.root.joinpath(f"{key}.lock")
+        try:
+            return os.fstat(fd).st_ino == lock_path.stat().st_ino
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def entry(self, key: str, is_complete: Callable[[Path], bool]):
+        """Lock the entry of key shared if complete, else exclusively to fill it.
+
+        Completeness is checked again once exclusively locked, in case another
+        job filled the entry meanwhile. Either way, the entry is then held
+        shared.
+        """
+        path = self.root.joinpath(key)
+        try:
+            fd = self._lock(key, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info(f"Waiting for another job filling cache entry {key}")
+            fd = self._lock(key, fcntl.LOCK_SH)
+        while not is_complete(path):
+            try:
+                # Not atomic: the shared lock is released first
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if self._current(fd, key) and not is_complete(path):
+                    break
+            except BlockingIOError:
+                # Other jobs found it incomplete too, let one of them fill it
+                pass
+            os.close(fd)
+            time.sleep(random.uniform(0.1, 1))
+            fd = self._lock(key, fcntl.LOCK_SH)
+        try:
+            path.mkdir(exist_ok=True)
+            yield path
+        except BaseException:
+            os.close(fd)
+            raise
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        os.utime(path)
+        self.held[key] = fd
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits budget."""
+        entries = [
+            path
+            for path in self.root.iterdir()
+            if path.is_dir()
+            and (
+                re.fullmatch(r"(manifest-)?[0-9a-f]{64}", path.name)
+                or path.name in UbuntuRelease.__members__
+            )
+        ]
+        sizes = {
+            path: sum(f.stat().st_blocks * 512 for f in path.iterdir())
+            for path in entries
+        }
+        total = sum(sizes.values())
+        for path in sorted(entries, key=lambda path: path.stat().st_mtime):
+            if total <= self.budget:
+                break
+            if path.name in self.held:
+                continue
+            try:
+                fd = self._lock(path.name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                logging.info(f"Evicting {path} from the ISO cache")
+                shutil.rmtree(path)
+                self.root.joinpath(f"{path.name}.lock").unlink()
+                total -= sizes[path]
+            finally:
+                os.close(fd)
+        if total > self.budget:
+            logging.warning(
+                f"ISO cache {self.root} uses {total/1024**3:.1f}GB, over its"
+                f" {self.budget/1024**3:.1f}GB budget"
+            )
+
+
 def get_release_iso(
     distro: str,
     release: str,
     flavor: InstallFlavor = InstallFlavor.LIVE_SERVER,
     arch: Optional[str] = "amd64",
     local_images_dir: Optional[str] = "/srv/iso",
+    parts: int = 4,
+    cache_budget: int = 50 * 1024**3,
 ) -> Path:
     if flavor == InstallFlavor.LIVE_SERVER:
         flavor_subdir = "ubuntu-server/"
@@ -203,55 +562,146 @@ def get_release_iso(
         iso_base_url = f"https://releases.ubuntu.com/{release}/"
     manifest_url = f"{iso_base_url}{base_name}.manifest"
     iso_url = f"{iso_base_url}{base_name}.iso"
-    iso_path = Path(f"{local_images_dir}/{release}/{base_name}.iso")
-    manifest_path = Path(f"{local_images_dir}/{release}/{base_name}.manifest")
-    manifest_sum = b"ABSENT"
-    iso_path.parent.mkdir(parents=True, exist_ok=True)
-    if manifest_path.exists():
-        p = subprocess.run(["md5sum", manifest_path], capture_output=True)
-        manifest_sum = p.stdout
-    r = requests.get(manifest_url, allow_redirects=True)
-    manifest_path.write_bytes(r.content)
-    if iso_path.exists():
-        logging.info(f"Checking md5sum of {manifest_path} for stale local ISO.")
-        p = subprocess.run(["md5sum", manifest_path], capture_output=True)
-        if p.stdout == manifest_sum:
-            logging.info(f"Using cached {iso_path} no manifest changes.")
-            return iso_path
-    logging.info(f"Downloading {iso_url} to {iso_path}...")
-    with requests.get(iso_url, stream=True) as r:
-        total_len = int(r.headers.get("Content-Length"))
-        r.raise_for_status()
-        total_chunks = total_len / 8192
-        print_step = total_chunks // 25
-        with open(iso_path, "wb") as stream:
-            for idx, chunk in enumerate(r.iter_content(chunk_size=8192)):
-                if idx % print_step == 0:
-                    print(
-                        f"{idx/print_step * 4}%"
-                        f" of {total_len/1024/1024/1000:.2f}GB downloaded",
-                        flush=True,
-                    )
-                stream.write(chunk)
+    session = iso_session(parts)
+    sha256 = get_iso_sha256(session, iso_base_url, f"{base_name}.iso")
+    r = session.get(manifest_url, allow_redirects=True, timeout=ISO_HTTP_TIMEOUT)
+    r.raise_for_status()
+    manifest = r.content
+    # Without SHA256SUMS, key by manifest content (and skip verification)
+    key = sha256 or "manifest-" + hashlib.sha256(manifest).hexdigest()
+
+    cache = IsoCache(Path(local_images_dir), cache_budget)
+    with cache.entry(
+        key, lambda entry: entry.joinpath(f"{base_name}.iso").exists()
+    ) as entry:
+        iso_path = entry.joinpath(f"{base_name}.iso")
+        if iso_path.exists():
+            logging.info(f"Using cached {iso_path}")
+        else:
+            logging.info(f"Downloading {iso_url} to {iso_path}...")
+            IsoDownload(session, iso_url, iso_path, sha256, parts).run()
+            entry.joinpath(f"{base_name}.manifest").write_bytes(manifest)
+    cache.evict()
     return iso_path
 
 
+ISO_SECTOR_SIZE = 2048
+
+
+def _rock_ridge_name(system_use: bytes) -> Optional[str]:
+    """Returns the Rock Ridge (NM entries) name of a directory record."""
+    name = b""
+    pos = 0
+    while pos + 4 <= len(system_use):
+        signature, length = system_use[pos : pos + 2], system_use[pos + 2]
+        if length < 4:
+            break
+        if signature == b"NM":
+            name += system_use[pos + 5 : pos + length]
+        pos += length
+    return name.decode(errors="replace") if name else None
+
+
+def iso9660_directory(iso, extent: int, size: int):
+    """Yield (name, extent, size) of the records of an ISO9660 directory.
+
+    Names are the Rock Ridge ones if any, else the ISO9660 ones lowercased
+    without version, as mkisofs/xorriso map them.
+    """
+    iso.seek(extent * ISO_SECTOR_SIZE)
+    data = iso.read(size)
+    pos = 0
+    while pos < len(data):
+        length = data[pos]
+        if length == 0:
+            # Records do not cross sectors, the rest of this one is padding
+            pos = (pos // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+            continue
+        record = data[pos : pos + length]
+        pos += length
+        name_length = record[32]
+        name = record[33 : 33 + name_length]
+        if name in (b"\x00", b"\x01"):
+            # . and ..
+            continue
+        system_use = record[33 + name_length + (1 - name_length % 2) :]
+        name = _rock_ridge_name(system_use) or (
+            name.decode(errors="replace").split(";")[0].rstrip(".").lower()
+        )
+        extent = int.from_bytes(record[2:6], "little")
+        yield name, extent, int.from_bytes(record[10:14], "little")
+
+
+def iso9660_find(iso, path: str) -> Tuple[int, int]:
+    """Returns the (extent, size) of path in an ISO9660 image."""
+    iso.seek(16 * ISO_SECTOR_SIZE)
+    descriptor = iso.read(ISO_SECTOR_SIZE)
+    if descriptor[:6] != b"\x01CD001":
+        raise ValueError("No ISO9660 primary volume descriptor")
+    root = descriptor[156:190]
+    extent = int.from_bytes(root[2:6], "little")
+    size = int.from_bytes(root[10:14], "little")
+    for component in path.strip("/").split("/"):
+        for name, child_extent, child_size in iso9660_directory(iso, extent, size):
+            if name == component:
+                extent, size = child_extent, child_size
+                break
+        else:
+            raise FileNotFoundError(f"{path} not found in ISO")
+    return extent, size
+
+
 def extract_kernel_initrd_from_iso(tmpdir: Path, iso_path: Path) -> Tuple[Path, Path]:
-    """Mount iso_path in tmpdir and extract vmlinuz and initrd to tmpdir."""
-    mnt_path = tmpdir.joinpath("mnt")
-    mnt_path.mkdir()
+    """Returns vmlinuz and initrd from iso_path, extracted next to it once.
+
+    The ISO is in a cache entry keyed by its checksum (see IsoCache), so
+    the extracted files are valid for as long as the ISO is. Only these two
+    files are read, by looking them up in the ISO9660 directory tree. If
+    that fails, they are extracted with bsdtar, in tmpdir.
+    """
+    kernel_path = iso_path.with_name(f"{iso_path.stem}.vmlinuz")
+    initrd_path = iso_path.with_name(f"{iso_path.stem}.initrd")
+    if kernel_path.exists() and initrd_path.exists():
+        logging.info(f"Using cached {kernel_path} and {initrd_path}")
+        return (kernel_path, initrd_path)
+
+    members = {"casper/vmlinuz": kernel_path, "casper/initrd": initrd_path}
+    try:
+        with open(iso_path, "rb") as iso:
+            for member, dest in members.items():
+                extent, size = iso9660_find(iso, member)
+                tmp_path = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+                iso.seek(extent * ISO_SECTOR_SIZE)
+                try:
+                    with open(tmp_path, "wb") as stream:
+                        while size:
+                            chunk = iso.read(min(size, 1024 * 1024))
+                            if not chunk:
+                                raise ValueError(f"{member} is truncated")
+                            stream.write(chunk)
+                            size -= len(chunk)
+                    # Atomic, for the other jobs sharing the cache entry
+                    os.replace(tmp_path, dest)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+        return (kernel_path, initrd_path)
+    except (ValueError, FileNotFoundError) as e:
+        logging.warning(f"Could not read {iso_path} as ISO9660 ({e}), using bsdtar")
+
     try:
         subprocess.check_call("command -v bsdtar", shell=True)
     except Exception:
         raise RuntimeError("Could not find bsdtar: sudo apt install libarchive-tools")
-    cmd = f"bsdtar -x -f {iso_path} casper"
-    logging.info(f"Running: {cmd}")
-    kernel_path = tmpdir.joinpath("vmlinuz")
-    initrd_path = tmpdir.joinpath("initrd")
-    subprocess.run(cmd.split(), capture_output=True)
-    shutil.copy("./casper/vmlinuz", kernel_path)
-    shutil.copy("./casper/initrd", initrd_path)
-    shutil.rmtree("casper", ignore_errors=True)
+    cmd = ["bsdtar", "-x", "-f", str(iso_path), "-C", str(tmpdir)] + list(members)
+    logging.info(f"Running: {' '.join(cmd)}")
+    subprocess.run(cmd, capture_output=True, check=True)
+    for member, dest in members.items():
+        tmp_path = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+        try:
+            shutil.copy(tmpdir.joinpath(member), tmp_path)
+            os.replace(tmp_path, dest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
     return (kernel_path, initrd_path)
 
 
@@ -271,18 +721,147 @@ def stream_cmd_stdout(cmd, stdout=None):
         cmd, shell=False, stdout=stdout, stdin=subprocess.DEVNULL
     )
     stdout_lines = []
-    while True:
-        output = None
-        if process.stdout:
-            output = process.stdout.readline()
-        if process.poll() is not None:
-            break
-        if output:
-            stdout_lines.append(output.decode())
-            print(stdout_lines[-1], end="", flush=True)
+    for output in process.stdout or []:
+        stdout_lines.append(output.decode())
+        print(stdout_lines[-1], end="", flush=True)
+    process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, cmd, "".join(stdout_lines)
+        )
     return "".join(stdout_lines)
 
 
+class VMMonitor:
+    """Report the lifecycle events of a launch_kvm VM as they happen.
+
+    Events are strings, from three sources:
+    - QMP: the VM events as qmp:<EVENT> (e.g. qmp:SHUTDOWN, qmp:RESET,
+      qmp:GUEST_PANICKED, which needs the pvpanic device of qemu_args()),
+      its run state at connection as status:<state>, and qmp:closed once
+      the QMP connection ended: QEMU exited, or could not be reached.
+    - The serial console log: the CONSOLE_MILESTONES, by name.
+    - ssh, once the guest sshd sent its banner on the forwarded port.
+    wait_for() returns as soon as one of the awaited events happened.
+    """
+
+    CONSOLE_MILESTONES = {
+        "login-prompt": re.compile(r"\S+ login: "),
+        "reboot": re.compile(r"reboot: (Restarting system|Power down)"),
+    }
+
+    def __init__(self, tmpdir: Path, vm_name: str):
+        self.qmp_path = tmpdir.joinpath(f"{vm_name}.qmp")
+        self.events = []
+        self.changed = threading.Condition()
+        self.stopped = threading.Event()
+
+    def qemu_args(self) -> List[str]:
+        return [
+            "-qmp",
+            f"unix:{self.qmp_path},server=on,wait=off",
+            # Reports guest kernel panics as GUEST_PANICKED events
+            "-device",
+            "pvpanic",
+        ]
+
+    def emit(self, event: str, data=None):
+        logging.info(f"VM event: {event} {data or ''}")
+        with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def wait_for(self, *events: str, timeout: float) -> str:
+        """Returns the first of events that happened, waiting up to timeout."""
+        with self.changed:
+            found = self.changed.wait_for(
+                lambda: next((e for e in self.events if e in events), None),
+                timeout,
+            )
+        if not found:
+            raise TimeoutError(f"None of {events} happened within {timeout}s")
+        return found
+
+    def stop(self):
+        self.stopped.set()
+
+    def _start(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def follow_qmp(self, timeout: float = 60):
+        self._start(self._follow_qmp, timeout)
+
+    def follow_console(self, console_path: Path):
+        self._start(self._follow_console, console_path)
+
+    def follow_ssh(self, ssh_port: int):
+        self._start(self._follow_ssh, ssh_port)
+
+    def _follow_qmp(self, timeout: float):
+        try:
+            self._read_qmp(timeout)
+        except (OSError, ValueError) as e:
+            # QEMU died mid-message
+            logging.warning(f"Lost QMP connection {self.qmp_path}: {e!r}")
+        finally:
+            self.emit("qmp:closed")
+
+    def _read_qmp(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # QEMU creates the socket once started
+            while True:
+                try:
+                    sock.connect(str(self.qmp_path))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if self.stopped.is_set() or time.monotonic() > deadline:
+                        logging.warning(f"Could not connect to {self.qmp_path}")
+                        return
+                    time.sleep(0.1)
+            stream = sock.makefile("r")
+            stream.readline()  # greeting
+            for command in ("qmp_capabilities", "query-status"):
+                sock.sendall(json.dumps({"execute": command}).encode() + b"\n")
+            for line in stream:
+                message = json.loads(line)
+                if "event" in message:
+                    self.emit(f"qmp:{message['event']}", message.get("data"))
+                elif "status" in (message.get("return") or {}):
+                    self.emit(f"status:{message['return']['status']}")
+
+    def _follow_console(self, console_path: Path):
+        with open(console_path, errors="replace") as console:
+            line = ""
+            while not self.stopped.is_set():
+                data = console.readline()
+                if not data:
+                    time.sleep(0.2)
+                    continue
+                line += data
+                # The login prompt has no newline
+                if not line.endswith("\n") and "login: " not in line:
+                    continue
+                for milestone, regex in self.CONSOLE_MILESTONES.items():
+                    if regex.search(line):
+                        self.emit(milestone, line.strip())
+                line = ""
+
+    def _follow_ssh(self, ssh_port: int):
+        # The user-mode network accepts connections on the forwarded port
+        # even before the guest listens: wait for the sshd banner instead.
+        while not self.stopped.is_set():
+            try:
+                with socket.create_connection(("127.0.0.1", ssh_port), 5) as sock:
+                    sock.settimeout(5)
+                    if sock.recv(4).startswith(b"SSH-"):
+                        self.emit("ssh")
+                        return
+            except OSError:
+                pass
+            time.sleep(1)
+
+
 def launch_kvm(
     vm_name: str,
     tmpdir: Path,
@@ -291,13 +870,18 @@ def launch_kvm(
     ssh_port: int,
     private_key: Path,
     username: str = "ubuntu",
+    disk_format: str = "raw",
     iso_path: Optional[Path] = None,
     seed_path: Optional[Path] = None,
     kernel_cmdline: Optional[str] = "",
     cmdline: Optional[list] = None,
     stdout=None,
+    monitor: Optional[VMMonitor] = None,
 ) -> KVMInstance:
-    """use qemu-kvm to setup and launch a test VM with optional kernel params"""
+    """use qemu-kvm to setup and launch a test VM with optional kernel params
+
+    With a monitor, the QMP events of the VM are reported to it.
+    """
     cmd = [
         "kvm",
         #        "-no-reboot",
@@ -306,7 +890,7 @@ def launch_kvm(
         "-m",
         ram_size,
         "-drive",
-        f"file={disk_img_path},format=raw,if=virtio",
+        f"file={disk_img_path},format={disk_format},if=virtio",
         "-net",
         "nic",
         "-D",
@@ -337,6 +921,9 @@ def launch_kvm(
         ]
     if cmdline:
         cmd += cmdline
+    if monitor:
+        cmd += monitor.qemu_args()
+        monitor.follow_qmp()
     if "-daemonize" not in cmd:
         cmd.append("-nographic")
         run_cmd = partial(stream_cmd_stdout, stdout=stdout)
@@ -436,28 +1023,65 @@ def main(args):
         pub_key_content = pub_key.read_text().rpartition(" ")[0]
         user_data = USER_DATA_AUTOINSTALL.format(kvm_pub_key_content=pub_key_content)
         seed_path = cloud_localds(tdir, user_data, meta_data="")
-        disk_img_path = create_qemu_disk(tdir, vm_name, "20G")
         iso_path = get_release_iso(
             "ubuntu",
             args.series,
             image_type,
             "amd64",
             local_images_dir=args.local_images_dir,
+            parts=args.download_parts,
+            cache_budget=int(args.cache_budget * 1024**3),
         )
         ssh_port = get_open_port()
-        kvm = launch_kvm(
-            vm_name=vm_name,
-            tmpdir=tdir,
-            ram_size=ram_size,
-            iso_path=iso_path,
-            seed_path=seed_path,
-            disk_img_path=disk_img_path,
-            ssh_port=ssh_port,
-            username="ephemeral",
-            private_key=private_key,
-            kernel_cmdline="console=ttyS0 autoinstall",
-        )
+        disk_format = args.disk_format
+        golden_path = golden_image_path(iso_path, user_data)
+        from_golden = args.from_golden and golden_path.exists()
+        if from_golden:
+            logging.info(f"Skipping install: first boot of an overlay of {golden_path}")
+            disk_format = "qcow2"
+            disk_img_path = create_qemu_disk(
+                tdir, vm_name, "20G", disk_format, backing=golden_path
+            )
+            kvm = KVMInstance(vm_name, "127.0.0.1", ssh_port, "ephemeral", private_key)
+        else:
+            disk_img_path = create_qemu_disk(tdir, vm_name, "20G", disk_format)
+            install_monitor = VMMonitor(tdir, vm_name)
+            kvm = launch_kvm(
+                vm_name=vm_name,
+                tmpdir=tdir,
+                ram_size=ram_size,
+                iso_path=iso_path,
+                seed_path=seed_path,
+                disk_img_path=disk_img_path,
+                disk_format=disk_format,
+                ssh_port=ssh_port,
+                username="ephemeral",
+                private_key=private_key,
+                kernel_cmdline="console=ttyS0 autoinstall",
+                monitor=install_monitor,
+            )
+            # QEMU exited: read all its QMP events, to tell the power off at
+            # the end of the install from a panic
+            install_monitor.wait_for("qmp:closed", timeout=60)
+            install_monitor.stop()
+            if "qmp:GUEST_PANICKED" in install_monitor.events:
+                logging.error("Install failed: the installer kernel panicked")
+                sys.exit(1)
         vm_name = vm_name.replace("ephemeral", "firstboot")
+        installed = None
+        if args.save_golden and not from_golden:
+            # Keep the installed disk as is until its first boot passed
+            installed = (disk_img_path, disk_format)
+            disk_img_path = create_qemu_disk(
+                tdir,
+                vm_name,
+                "20G",
+                "qcow2",
+                backing=disk_img_path,
+                backing_format=disk_format,
+            )
+            disk_format = "qcow2"
+        monitor = VMMonitor(tdir, vm_name)
         with open("first-boot-console.log", "w+") as first_boot_log:
             x = threading.Thread(
                 target=launch_kvm,
@@ -466,14 +1090,23 @@ def main(args):
                     "tmpdir": tdir,
                     "ram_size": ram_size,
                     "disk_img_path": disk_img_path,
+                    "disk_format": disk_format,
                     "ssh_port": ssh_port,
                     "username": "ubuntu",
                     "private_key": private_key,
                     "stdout": first_boot_log,
+                    "monitor": monitor,
                 },
             )
             x.start()
-            time.sleep(30)
+            monitor.follow_console(Path(first_boot_log.name))
+            monitor.follow_ssh(ssh_port)
+            event = monitor.wait_for(
+                "ssh", "qmp:SHUTDOWN", "qmp:GUEST_PANICKED", "qmp:closed", timeout=1800
+            )
+            if event != "ssh":
+                logging.error(f"First boot failed before ssh was up: {event}")
+                sys.exit(1)
             kvm.username = "ubuntu"  # First boot uses ubuntu default user
             ci_status = kvm.wait_for_cloud_init()
             print("===== Validate ephemeral boot state =====")
@@ -497,6 +1130,8 @@ def main(args):
                 kvm.execute(["sudo", "cloud-init", "query", "userdata"]).decode()
             )
             kvm.shutdown()
+            monitor.wait_for("qmp:SHUTDOWN", "qmp:closed", timeout=300)
+            monitor.stop()
         if log_errors_and_warnings(first_boot_log):
             sys.exit(1)
         if log_errors_and_warnings(first_boot_log):
@@ -522,6 +1157,8 @@ def main(args):
             "SUCCESS: cloud-init disabled on first boot, user-data honored,"
             " no errors found in logs"
         )
+        if installed:
+            save_golden_image(*installed, golden_path)
 
 
 if __name__ == "__main__":
@@ -532,6 +1169,37 @@ if __name__ == "__main__":
         default="/srv/iso",
         help="Local path to where ISOs are downloaded. Default: /srv/iso/",
     )
+    parser.add_argument(
+        "--cache-budget",
+        type=float,
+        default=50,
+        help="Disk budget of the ISO cache in GB, least recently used ISOs"
+        " are evicted beyond it. Default: 50",
+    )
+    parser.add_argument(
+        "--disk-format",
+        default="raw",
+        choices=["raw", "qcow2"],
+        help="Format of the target VM disk. Default: raw",
+    )
+    parser.add_argument(
+        "--save-golden",
+        action="store_true",
+        help="Save the installed disk as a golden image, keyed by ISO and"
+        " user-data, next to the cached ISO, once its first boot passed",
+    )
+    parser.add_argument(
+        "--from-golden",
+        action="store_true",
+        help="Skip the install if a golden image exists, and only test the"
+        " first boot, on a qcow2 overlay of the golden image",
+    )
+    parser.add_argument(
+        "--download-parts",
+        type=int,
+        default=4,
+        help="Parallel range requests of ISO downloads. Default: 4",
+    )
     parser.add_argument(
         "-i",
         "--image-type",
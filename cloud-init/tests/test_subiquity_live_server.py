@@ -0,0 +1,512 @@
+"""Tests of subiquity_live_server.py against local stand-in servers.
+
+Run with: python3 -m pytest cloud-init/tests
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import subiquity_live_server as sls  # noqa: E402
+
+SEGMENT_SIZE = 64 * 1024
+PAYLOAD = os.urandom(10 * SEGMENT_SIZE + 123)
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class IsoHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, with range requests unless server.ranges is False."""
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", '"payload"')
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(PAYLOAD))
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not (match and self.server.ranges):
+            self.server.requests.append(None)
+            self._headers(200, len(PAYLOAD))
+            self.wfile.write(PAYLOAD)
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        self.server.requests.append(start // SEGMENT_SIZE)
+        if start in self.server.stall:
+            # Stall once: headers sent, no data
+            self.server.stall.discard(start)
+            self._headers(206, end + 1 - start)
+            self.wfile.flush()
+            self.server.release.wait(10)
+            return
+        self._headers(206, end + 1 - start)
+        self.wfile.write(PAYLOAD[start : end + 1])
+
+
+@pytest.fixture
+def iso_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IsoHandler)
+    server.daemon_threads = True
+    server.ranges = True
+    server.requests = []
+    server.stall = set()
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def download(iso_server, dest, sha256=PAYLOAD_SHA256, **kwargs):
+    url = f"http://127.0.0.1:{iso_server.server_address[1]}/test.iso"
+    return sls.IsoDownload(
+        sls.iso_session(3), url, dest, sha256, 3, SEGMENT_SIZE, **kwargs
+    ).run()
+
+
+def test_download_ranges(iso_server, tmp_path):
+    dest = download(iso_server, tmp_path / "test.iso")
+    assert dest.read_bytes() == PAYLOAD
+    assert sorted(iso_server.requests) == list(range(11))
+    assert not (tmp_path / "test.iso.part").exists()
+    assert not (tmp_path / "test.iso.part.json").exists()
+
+
+def test_download_resume(iso_server, tmp_path):
+    dest = tmp_path / "test.iso"
+    # An interrupted download: only the even segments are complete
+    done = list(range(0, 11, 2))
+    partial = bytearray(len(PAYLOAD))
+    for segment in done:
+        start = segment * SEGMENT_SIZE
+        partial[start : start + SEGMENT_SIZE] = PAYLOAD[start : start + SEGMENT_SIZE]
+    (tmp_path / "test.iso.part").write_bytes(partial)
+    url = f"http://127.0.0.1:{iso_server.server_address[1]}/test.iso"
+    state = {
+        "url": url,
+        "size": len(PAYLOAD),
+        "validator": '"payload"',
+        "segment_size": SEGMENT_SIZE,
+        "done": done,
+    }
+    (tmp_path / "test.iso.part.json").write_text(json.dumps(state))
+
+    assert download(iso_server, dest).read_bytes() == PAYLOAD
+    assert sorted(iso_server.requests) == list(range(1, 11, 2))
+
+
+def test_download_sha256_mismatch(iso_server, tmp_path):
+    with pytest.raises(RuntimeError, match="SHA256 mismatch"):
+        download(iso_server, tmp_path / "test.iso", sha256="0" * 64)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_without_ranges(iso_server, tmp_path):
+    iso_server.ranges = False
+    assert download(iso_server, tmp_path / "test.iso").read_bytes() == PAYLOAD
+    assert iso_server.requests == [None]
+
+
+def test_download_stalled_segment(iso_server, tmp_path):
+    iso_server.stall.add(3 * SEGMENT_SIZE)
+    dest = download(iso_server, tmp_path / "test.iso", timeout=(5, 0.5))
+    assert dest.read_bytes() == PAYLOAD
+    assert iso_server.requests.count(3) == 2
+
+
+def test_stream_cmd_stdout(capsys):
+    assert sls.stream_cmd_stdout(["sh", "-c", "echo a; echo b"]) == "a\nb\n"
+    assert capsys.readouterr().out == "a\nb\n"
+    with pytest.raises(subprocess.CalledProcessError) as failed:
+        sls.stream_cmd_stdout(["sh", "-c", "echo a; exit 3"])
+    assert (failed.value.returncode, failed.value.output) == (3, "a\n")
+
+
+def cache_entry(root, name, size, age):
+    entry = root.joinpath(name)
+    entry.mkdir()
+    entry.joinpath("ubuntu.iso").write_bytes(os.urandom(size))
+    mtime = entry.stat().st_mtime - age
+    os.utime(entry, (mtime, mtime))
+    return entry
+
+
+def test_cache_evicts_legacy_release_dirs(tmp_path):
+    old = cache_entry(tmp_path, "a" * 64, 64 * 1024, 100)
+    new = cache_entry(tmp_path, "b" * 64, 64 * 1024, 10)
+    legacy = cache_entry(tmp_path, "jammy", 64 * 1024, 50)
+    other = cache_entry(tmp_path, "golden", 64 * 1024, 1000)
+    sls.IsoCache(tmp_path, 100 * 1024).evict()
+    assert not old.exists() and not legacy.exists()
+    assert new.exists() and other.exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["b" * 64, "golden"]
+
+
+def flock_nb(path, operation):
+    """Try to flock path from another open file description."""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def test_cache_entry_locks(tmp_path):
+    cache = sls.IsoCache(tmp_path, 1024**3)
+    lock_path = tmp_path.joinpath("a" * 64 + ".lock")
+    with cache.entry("a" * 64, lambda entry: False) as entry:
+        # Filled exclusively
+        assert entry == tmp_path.joinpath("a" * 64) and entry.is_dir()
+        assert not flock_nb(lock_path, fcntl.LOCK_SH)
+        entry.joinpath("ubuntu.iso").write_bytes(b"iso")
+    # Then held shared
+    assert "a" * 64 in cache.held
+    assert flock_nb(lock_path, fcntl.LOCK_SH)
+    assert not flock_nb(lock_path, fcntl.LOCK_EX)
+
+    # Complete entries are only ever locked shared
+    other = sls.IsoCache(tmp_path, 1024**3)
+    with other.entry("a" * 64, lambda entry: True):
+        assert flock_nb(lock_path, fcntl.LOCK_SH)
+    assert "a" * 64 in other.held
+
+
+def test_cache_evicts_lru_unlocked(tmp_path, caplog):
+    cache = sls.IsoCache(tmp_path, 100 * 1024)
+    held = cache_entry(tmp_path, "a" * 64, 64 * 1024, 0)
+    with cache.entry(held.name, lambda entry: True):
+        pass
+    os.utime(held, (0, 0))
+    old = cache_entry(tmp_path, "b" * 64, 64 * 1024, 300)
+    older = cache_entry(tmp_path, "c" * 64, 64 * 1024, 400)
+    new = cache_entry(tmp_path, "d" * 64, 64 * 1024, 100)
+    # Locked by another job
+    busy = cache_entry(tmp_path, "e" * 64, 64 * 1024, 500)
+    busy_fd = os.open(tmp_path.joinpath(busy.name + ".lock"), os.O_RDWR | os.O_CREAT)
+    fcntl.flock(busy_fd, fcntl.LOCK_SH)
+    try:
+        cache.evict()
+    finally:
+        os.close(busy_fd)
+    assert held.exists() and busy.exists()
+    assert not older.exists() and not old.exists() and not new.exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "a" * 64,
+        "a" * 64 + ".lock",
+        "e" * 64,
+        "e" * 64 + ".lock",
+    ]
+    assert "over its" in caplog.text
+
+    # Once released, the least recently used entry goes first, lock included
+    os.close(cache.held.pop(held.name))
+    cache.evict()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["e" * 64, "e" * 64 + ".lock"]
+
+
+def make_iso(tmp_path, files, options=None):
+    """Build an ISO of files ({path: content}) with bsdtar."""
+    src = tmp_path.joinpath("iso-src")
+    for name, content in files.items():
+        src.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        src.joinpath(name).write_bytes(content)
+    iso_path = tmp_path.joinpath("entry", "ubuntu.iso")
+    iso_path.parent.mkdir()
+    cmd = ["bsdtar", "--format", "iso9660", "-cf", str(iso_path), "-C", str(src)]
+    if options:
+        cmd += ["--options", options]
+    subprocess.run(cmd + ["."], check=True)
+    shutil.rmtree(src)
+    return iso_path
+
+
+needs_bsdtar = pytest.mark.skipif(not shutil.which("bsdtar"), reason="no bsdtar")
+
+
+@needs_bsdtar
+def test_extract_truncated_iso(tmp_path):
+    kernel, initrd = os.urandom(300000), os.urandom(500000)
+    iso_path = make_iso(tmp_path, {"casper/vmlinuz": kernel, "casper/initrd": initrd})
+    with open(iso_path, "rb") as iso:
+        extent, size = sls.iso9660_find(iso, "casper/initrd")
+    os.truncate(iso_path, extent * sls.ISO_SECTOR_SIZE + size // 2)
+    tmp_path.joinpath("work").mkdir()
+    # The bsdtar fallback fails too
+    with pytest.raises(subprocess.CalledProcessError):
+        sls.extract_kernel_initrd_from_iso(tmp_path / "work", iso_path)
+    assert not list(iso_path.parent.glob("*.tmp"))
+    assert not iso_path.with_name("ubuntu.initrd").exists()
+
+
+def test_rock_ridge_name():
+    def entry(signature, data):
+        return signature + bytes([4 + len(data), 1]) + data
+
+    # NM entries (flags byte, then name) continue each other
+    system_use = (
+        entry(b"PX", bytes(32))
+        + entry(b"NM", b"\x01casper-")
+        + entry(b"NM", b"\x00Vmlinuz")
+    )
+    assert sls._rock_ridge_name(system_use) == "casper-Vmlinuz"
+    assert sls._rock_ridge_name(entry(b"PX", bytes(32))) is None
+    assert sls._rock_ridge_name(b"") is None
+    # Padding or garbage ends the entries
+    assert sls._rock_ridge_name(b"NM\x00\x01" + entry(b"NM", b"\x00x")) is None
+
+
+ISO_FILES = {
+    "casper/vmlinuz": os.urandom(300000),
+    "casper/initrd": os.urandom(5000),
+    "boot/grub/grub.cfg": b"menuentry",
+}
+
+
+@needs_bsdtar
+@pytest.mark.parametrize("options", [None, "iso9660:!rockridge"])
+def test_iso9660_find(tmp_path, options):
+    iso_path = make_iso(tmp_path, ISO_FILES, options)
+    with open(iso_path, "rb") as iso:
+        for path, content in ISO_FILES.items():
+            extent, size = sls.iso9660_find(iso, path)
+            iso.seek(extent * sls.ISO_SECTOR_SIZE)
+            assert iso.read(size) == content
+        with pytest.raises(FileNotFoundError):
+            sls.iso9660_find(iso, "casper/filesystem.squashfs")
+        with pytest.raises(FileNotFoundError):
+            sls.iso9660_find(iso, "boot/vmlinuz")
+
+
+@needs_bsdtar
+def test_iso9660_find_rock_ridge_names(tmp_path):
+    files = {"Casper/vmlinuz-6.8.0-generic": b"kernel"}
+    iso_path = make_iso(tmp_path, files)
+    with open(iso_path, "rb") as iso:
+        extent, size = sls.iso9660_find(iso, "Casper/vmlinuz-6.8.0-generic")
+        iso.seek(extent * sls.ISO_SECTOR_SIZE)
+        assert iso.read(size) == b"kernel"
+        # Not the lowercased ISO9660 names
+        with pytest.raises(FileNotFoundError):
+            sls.iso9660_find(iso, "casper/vmlinuz-6.8.0-generic")
+
+
+def test_iso9660_find_not_iso(tmp_path):
+    tmp_path.joinpath("not.iso").write_bytes(bytes(20 * sls.ISO_SECTOR_SIZE))
+    with open(tmp_path.joinpath("not.iso"), "rb") as iso:
+        with pytest.raises(ValueError):
+            sls.iso9660_find(iso, "casper/vmlinuz")
+
+
+@needs_bsdtar
+def test_extract_kernel_initrd_from_iso(tmp_path, caplog, monkeypatch):
+    iso_path = make_iso(tmp_path, ISO_FILES)
+    tmp_path.joinpath("work").mkdir()
+    kernel_path, initrd_path = sls.extract_kernel_initrd_from_iso(
+        tmp_path / "work", iso_path
+    )
+    assert kernel_path.read_bytes() == ISO_FILES["casper/vmlinuz"]
+    assert initrd_path.read_bytes() == ISO_FILES["casper/initrd"]
+    assert kernel_path.parent == iso_path.parent
+    assert not list(tmp_path.joinpath("work").iterdir())
+    assert "bsdtar" not in caplog.text
+
+    # Extracted once
+    iso_path.write_bytes(b"")
+    assert sls.extract_kernel_initrd_from_iso(tmp_path / "work", iso_path) == (
+        kernel_path,
+        initrd_path,
+    )
+
+
+def fake_qemu(monitor, events):
+    """Serve QMP on the monitor socket as QEMU does, sending events then exiting"""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(monitor.qmp_path))
+    server.listen(1)
+
+    def serve():
+        with server, server.accept()[0] as conn:
+            commands = conn.makefile("r")
+            conn.sendall(b'{"QMP": {"version": {}, "capabilities": []}}\n')
+            for line in commands:
+                command = json.loads(line)["execute"]
+                if command == "query-status":
+                    reply = {"return": {"status": "running", "running": True}}
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                    break
+                conn.sendall(b'{"return": {}}\n')
+            for event in events:
+                conn.sendall(json.dumps({"event": event}).encode() + b"\n")
+
+    threading.Thread(target=serve, daemon=True).start()
+
+
+def test_monitor_qmp(tmp_path):
+    monitor = sls.VMMonitor(tmp_path, "vm")
+    assert monitor.qemu_args() == [
+        "-qmp",
+        f"unix:{tmp_path}/vm.qmp,server=on,wait=off",
+        "-device",
+        "pvpanic",
+    ]
+    fake_qemu(monitor, ["GUEST_PANICKED", "SHUTDOWN"])
+    monitor.follow_qmp(timeout=5)
+    assert monitor.wait_for("qmp:SHUTDOWN", "qmp:GUEST_PANICKED", timeout=5) == (
+        "qmp:GUEST_PANICKED"
+    )
+    monitor.wait_for("qmp:closed", timeout=5)
+    assert monitor.events == [
+        "status:running",
+        "qmp:GUEST_PANICKED",
+        "qmp:SHUTDOWN",
+        "qmp:closed",
+    ]
+
+
+def test_monitor_console(tmp_path):
+    console = tmp_path.joinpath("console.log")
+    console.write_text("Booting\n")
+    monitor = sls.VMMonitor(tmp_path, "vm")
+    monitor.follow_console(console)
+    with open(console, "a") as stream:
+        # The login prompt waits for input, without newline
+        stream.write("Ubuntu 24.04 LTS target-test ttyS0\n\ntarget-test login: ")
+        stream.flush()
+        event = monitor.wait_for("login-prompt", "reboot", timeout=5)
+        assert event == "login-prompt"
+        stream.write("\n[   42.000000] reboot: Power down\n")
+        stream.flush()
+        assert monitor.wait_for("reboot", timeout=5)
+    monitor.stop()
+    assert monitor.events == ["login-prompt", "reboot"]
+
+
+def test_monitor_ssh(tmp_path):
+    with socket.socket() as sshd:
+        sshd.bind(("127.0.0.1", 0))
+        sshd.listen(1)
+
+        def banner():
+            conn = sshd.accept()[0]
+            with conn:
+                conn.sendall(b"SSH-2.0-OpenSSH_9.6\r\n")
+
+        threading.Thread(target=banner, daemon=True).start()
+        monitor = sls.VMMonitor(tmp_path, "vm")
+        monitor.follow_ssh(sshd.getsockname()[1])
+        assert monitor.wait_for("ssh", "qmp:closed", timeout=5) == "ssh"
+        monitor.stop()
+
+
+def test_monitor_wait_for_timeout(tmp_path):
+    monitor = sls.VMMonitor(tmp_path, "vm")
+    monitor.emit("qmp:RESET")
+    with pytest.raises(TimeoutError):
+        monitor.wait_for("ssh", timeout=0.1)
+
+
+def test_monitor_qmp_unreachable(tmp_path):
+    monitor = sls.VMMonitor(tmp_path, "vm")
+    monitor.follow_qmp(timeout=0.2)
+    monitor.wait_for("qmp:closed", timeout=5)
+    assert monitor.events == ["qmp:closed"]
+
+
+def test_monitor_qmp_reset(tmp_path):
+    monitor = sls.VMMonitor(tmp_path, "vm")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(monitor.qmp_path))
+    server.listen(1)
+    monitor.follow_qmp(timeout=5)
+    conn = server.accept()[0]
+    # QEMU killed while writing an event
+    conn.sendall(b'{"QMP": {}}\n{"event": "SHUTD')
+    conn.close()
+    server.close()
+    monitor.wait_for("qmp:closed", timeout=5)
+    assert monitor.events == ["qmp:closed"]
+
+
+FAKE_KVM = """#!{python}
+# Stands in for QEMU: serves QMP, and reports a guest panic only with the
+# pvpanic device
+import json, socket, sys
+
+args = sys.argv[1:]
+qmp_path = args[args.index("-qmp") + 1].split(",")[0][len("unix:"):]
+panic = "pvpanic" in args[args.index("-device") + 1 :]
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(qmp_path)
+server.listen(1)
+conn = server.accept()[0]
+commands = conn.makefile("r")
+conn.sendall(b'{{"QMP": {{}}}}\\n')
+for command in range(2):
+    commands.readline()
+    conn.sendall(b'{{"return": {{"status": "running"}}}}\\n')
+events = ["GUEST_PANICKED", "SHUTDOWN"] if panic else ["SHUTDOWN"]
+for event in events:
+    conn.sendall(json.dumps({{"event": event}}).encode() + b"\\n")
+"""
+
+
+def test_main_install_panic(tmp_path, monkeypatch, caplog):
+    bin_dir = tmp_path.joinpath("bin")
+    bin_dir.mkdir()
+    bin_dir.joinpath("kvm").write_text(FAKE_KVM.format(python=sys.executable))
+    bin_dir.joinpath("kvm").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("key.pub").write_text("ssh-rsa AAAA test@host\n")
+    monkeypatch.setattr(
+        sls,
+        "get_or_create_rsa_key",
+        lambda path: (tmp_path / "key", tmp_path / "key.pub"),
+    )
+    monkeypatch.setattr(sls, "cloud_localds", lambda *args, **kw: tmp_path / "seed")
+    iso_path = tmp_path.joinpath("0123abcd", "ubuntu.iso")
+    monkeypatch.setattr(sls, "get_release_iso", lambda *args, **kw: iso_path)
+    monkeypatch.setattr(
+        sls,
+        "extract_kernel_initrd_from_iso",
+        lambda tmpdir, iso: (tmpdir / "vmlinuz", tmpdir / "initrd"),
+    )
+    args = sls.argparse.Namespace(
+        image_type="server",
+        series="noble",
+        local_images_dir=str(tmp_path),
+        download_parts=1,
+        cache_budget=1,
+        disk_format="raw",
+        save_golden=False,
+        from_golden=False,
+    )
+    with pytest.raises(SystemExit):
+        sls.main(args)
+    assert "the installer kernel panicked" in caplog.text
@@ -0,0 +1,120 @@
+"""Micro-benchmarks of the data2influx parsers, on synthetic large inputs.
+
+Needs pytest-benchmark. The file is not collected by a plain pytest run,
+pass it explicitly, e.g. to save a baseline and later compare against it:
+
+    python3 -m pytest benchmarks/bench_parsers.py --benchmark-autosave
+    python3 -m pytest benchmarks/bench_parsers.py \\
+        --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data2influx  # noqa: E402
+
+RESULT = ("results-{}-0123456789abcdef-noble-container-c2-m4"
+          "-2024-01-01T00:00:00Z-loaded.txt")
+
+PROCESSES = ("systemd", "kworker/0:1-events", "rcu_sched", "scsi_eh_0",
+             "ext4lazyinit", "sshd", "bash", "snapd")
+PREDICATES = ("OK", "MEDIUM", "EXPOSED", "UNSAFE")
+
+
+def write_result(directory, measurement, lines):
+    fname = str(directory / RESULT.format(measurement))
+    with open(fname, "w", encoding="utf-8") as resultf:
+        resultf.writelines(lines)
+    return fname
+
+
+@pytest.fixture(scope="module")
+def results(tmp_path_factory):
+    """Result files of every parsed metric type, by metric type."""
+
+    directory = tmp_path_factory.mktemp("results")
+    meminfo_keys = (data2influx.PARSERS["metric_meminfo"].fields
+                    + tuple(f"Extra{i}" for i in range(50)))
+    return {
+        "metric_processcount": write_result(
+            directory, "processcount",
+            ["    PID TTY          TIME CMD\n"]
+            + [f"{pid:7} ?        00:00:00 "
+               f"{PROCESSES[pid % len(PROCESSES)]}\n"
+               for pid in range(100000)]),
+        "metric_systemservicesecurity": write_result(
+            directory, "systemservicesecurity",
+            ["UNIT                                 EXPOSURE PREDICATE HAPPY\n"]
+            + [f"unit-{i}.service {i % 100 / 10:.1f} "
+               f"{PREDICATES[i % len(PREDICATES)]} :-)\n"
+               for i in range(100000)]),
+        "metric_packages": write_result(
+            directory, "packages",
+            [f"Desired=Unknown/Install/Remove/Purge/Hold {i}\n"
+             for i in range(5)]
+            + [f"ii  package-{i} 1.0-1 amd64 Some package\n"
+               for i in range(100000)]),
+        "metric_ports": write_result(
+            directory, "ports",
+            ["Netid State Recv-Q Send-Q Local Address:Port Peer\n"]
+            + [f"tcp LISTEN 0 128 0.0.0.0:{i} 0.0.0.0:*\n"
+               for i in range(100000)]),
+        "metric_meminfo": write_result(
+            directory, "meminfo",
+            [f"{key}: {i * 1024} kB\n" for i, key in enumerate(meminfo_keys)]),
+        "metric_diskdetail": write_result(
+            directory, "diskdetail",
+            [f"{i}\t/usr/share/dir-{i // 100}/sub-{i}\n"
+             for i in range(200000)]
+            + [f"{i}\t/usr/share/dir-{i}\n" for i in range(2000)]
+            + ["123456\t/usr/share\n", "234567\t/usr\n",
+               "345678\t/\n"]),
+        "metric_packagesizes": write_result(
+            directory, "packagesizes",
+            [f"{i}\tpackage-{i}\n" for i in range(100000)]),
+        "metric_apt": write_result(
+            directory, "apt",
+            ["1024\t/var/lib/apt/\n", "2048\t/var/cache/apt/\n"]),
+    }
+
+
+@pytest.mark.parametrize("metrictype", ["metric_processcount",
+                                        "metric_systemservicesecurity",
+                                        "metric_packages",
+                                        "metric_ports",
+                                        "metric_meminfo",
+                                        "metric_diskdetail",
+                                        "metric_packagesizes",
+                                        "metric_apt"])
+def test_parser(benchmark, results, metrictype):
+    parser = data2influx.PARSERS[metrictype]
+    point = {}
+    benchmark(parser.parse, results[metrictype], point)
+    assert tuple(point["fields"]) == parser.fields
+    if parser.top:
+        assert len(point["top"]) == data2influx.TOP_N
+
+
+def test_processcount_counts(results):
+    point = {}
+    data2influx.parse_processcount_measurement(
+        results["metric_processcount"], point)
+    assert point["fields"]["systemd"] == 12500
+    assert point["fields"]["proccount"] == 100000 - 5 * 12500 + 1
+
+
+def test_build_encode(benchmark, results):
+    fname = results["metric_meminfo"]
+    line = benchmark(lambda: data2influx.encode_point(
+        data2influx.build_points(fname, "metric_meminfo")[0]))
+    assert line.startswith("metric_meminfo,cpu=2,")
+
+
+def test_metrictype_from_filename(benchmark):
+    fname = RESULT.format("systemservicesecurity")
+    assert benchmark(data2influx.metrictype_from_filename,
+                     fname) == "metric_systemservicesecurity"
@@ -2,18 +2,35 @@
 """Parse various metrics of spec US013 and populate the InfluxDB."""
 
 import argparse
+import fcntl
+import glob
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import re
+import sqlite3
 import sys
+import threading
+import time
+import zlib
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
+from queue import Queue
 from statistics import mean
 
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 
 
 def influx_connect():
-    """Connect to an InfluxDB instance."""
+    """Connect to an InfluxDB instance, with gzip-compressed requests."""
     try:
         hostname = os.environ["INFLUXDB_HOSTNAME"]
         port = os.environ["INFLUXDB_PORT"]
@@ -24,50 +41,95 @@ def influx_connect():
         print("error: please source influx credentials before running")
         sys.exit(1)
 
-    return InfluxDBClient(hostname, port, username, password, database)
+    return InfluxDBClient(hostname, port, username, password, database,
+                          gzip=True)
 
 
 def filename_to_tokens(fname):
     """Converts a filename following an agreed pattern to tokens"""
-    rstr = (r"results-[a-z]*-(\w+)-(\w+)-(\w+)-(\w+)-(\w+)-(.+)"
+    rstr = (r"results-([a-z]*)-(\w+)-(\w+)-(\w+)-(\w+)-(\w+)-(.+)"
             r"-(\w+)\.(txt|json)")
     fname_tokens = re.search(rstr, fname)
     tokens = {
-            "machineid": fname_tokens.group(1),
-            "release": fname_tokens.group(2),
-            "what": fname_tokens.group(3),
-            "cpu": int(fname_tokens.group(4)[1:]),
-            "mem": int(fname_tokens.group(5)[1:]),
-            "timestamp": fname_tokens.group(6),
-            "stage": fname_tokens.group(7)
+            "measurement": fname_tokens.group(1),
+            "machineid": fname_tokens.group(2),
+            "release": fname_tokens.group(3),
+            "what": fname_tokens.group(4),
+            "cpu": int(fname_tokens.group(5)[1:]),
+            "mem": int(fname_tokens.group(6)[1:]),
+            "timestamp": fname_tokens.group(7),
+            "stage": fname_tokens.group(8)
             }
     return tokens
 
 
+# How to parse a metric type: its measurement token in the result file
+# names (and the stages used, None for all), the parser, which fills the
+# fields of a point from a result file, and the names of these fields
+# (None if they depend on the data). delta tells whether the fields are
+# also diffed between stages (see stage_deltas). With top (a tag name),
+# the parser also fills point["top"] with {name: size} items, written as
+# one <metrictype>_top point each, with name as top tag and a size field
+# (see build_points).
+MetricParser = namedtuple("MetricParser",
+                          ["token", "parse", "fields", "stages", "delta",
+                           "top"],
+                          defaults=[None, False, None])
+
+PARSERS = {}
+
+
+def register_parser(metrictype, token, fields, stages=None, delta=False,
+                    top=None):
+    """Decorator registering the parser of a metric type."""
+
+    def register(parse):
+        PARSERS[metrictype] = MetricParser(
+            token, parse, None if fields is None else tuple(fields), stages,
+            delta, top)
+        return parse
+    return register
+
+
+def metrictype_from_filename(fname):
+    """Infer the metric type from a result filename, None if unparsed."""
+    try:
+        tokens = filename_to_tokens(os.path.basename(fname))
+    except AttributeError:
+        return None
+
+    for metrictype, parser in PARSERS.items():
+        if parser.token != tokens["measurement"]:
+            continue
+        if parser.stages and tokens["stage"] not in parser.stages:
+            return None
+        return metrictype
+    return None
+
+
+PROCESS_PREFIXES = ("kworker", "scsi_", "systemd", "rcu_", "ext4lazyinit")
+
+
+@register_parser("metric_processcount", "processcount",
+                 PROCESS_PREFIXES + ("proccount",), delta=True)
 def parse_processcount_measurement(fname, point):
     """Parse raw data of processcount and extract measurement."""
 
-    count = {"kworker": 0,
-             "scsi_": 0,
-             "systemd": 0,
-             "rcu_": 0,
-             "ext4lazyinit": 0}
+    count = dict.fromkeys(PROCESS_PREFIXES, 0)
     count_others = 0
 
     with open(fname, "r", encoding="utf-8") as processlist:
-        lines = processlist.readlines()
-        for line in lines:
-            counted = False
-            for prefix in count:
-                try:
-                    if line.split()[3].startswith(prefix):
-                        count[prefix] += 1
-                        counted = True
-                        break
-                except IndexError:
-                    break
-            if not counted:
+        for line in processlist:
+            # ps -e: PID TTY TIME CMD, CMD being the 4th column
+            entries = line.split(None, 4)
+            if len(entries) < 4 or not entries[3].startswith(
+                    PROCESS_PREFIXES):
                 count_others += 1
+                continue
+            for prefix in PROCESS_PREFIXES:
+                if entries[3].startswith(prefix):
+                    count[prefix] += 1
+                    break
 
     point["fields"] = {}
     for prefix, prefixcount in count.items():
@@ -75,6 +137,11 @@ def parse_processcount_measurement(fname, point):
     point["fields"]["proccount"] = count_others
 
 
+# The ssh_noninteractive point is built from the "warm" results file,
+# which references the "first" one.
+@register_parser("ssh_noninteractive", "ssh",
+                 ("first", "mean", "stddev", "median", "min", "max"),
+                 stages=("warm",))
 def parse_ssh_measurement(fname, point):
     """Parse raw data of ssh login speed and extract measurement."""
 
@@ -98,6 +165,9 @@ def parse_ssh_measurement(fname, point):
     }
 
 
+@register_parser("metric_cpustat", "cpustat",
+                 ("user", "sys", "idle", "wait", "steal", "boot_usr",
+                  "boot_sys", "boot_idle", "boot_wait", "boot_steal"))
 def parse_cpustat_measurement(fname, point):
     """Parse raw data of vmstat output and extract measurement."""
 
@@ -124,6 +194,7 @@ def parse_cpustat_measurement(fname, point):
     }
 
 
+@register_parser("metric_disk", "disk", ("usedmb",))
 def parse_disk_measurement(fname, point):
     """Parse raw data of df output and extract measurement."""
 
@@ -140,12 +211,12 @@ def parse_disk_measurement(fname, point):
     }
 
 
+@register_parser("metric_apt", "apt", ("cache", "lists"))
 def parse_apt_measurement(fname, point):
     """Parse raw data of du on apt dirs and extract measurement."""
 
     with open(fname, "r", encoding="utf-8") as rawdataf:
-        apt_lines = rawdataf.readlines()
-        for apt_line in apt_lines:
+        for apt_line in rawdataf:
             apt_entries = apt_line.split()
             if apt_entries[1] == "/var/lib/apt/":
                 apt_list_size = int(apt_entries[0])
@@ -158,33 +229,38 @@ def parse_apt_measurement(fname, point):
     }
 
 
+@register_parser("metric_ports", "ports", ("portcount",), delta=True)
 def parse_ports_measurement(fname, point):
     """Parse raw port data of ss output and extract measurement."""
 
     with open(fname, "r", encoding="utf-8") as portlist:
         # minus header
-        count = len(portlist.readlines()) - 1
+        count = sum(1 for _ in portlist) - 1
 
     point["fields"] = {"portcount": int(count)}
 
 
+@register_parser("metric_packages", "packages", ("pkgcount",), delta=True)
 def parse_packages_measurement(fname, point):
     """Parse raw package data of dpkg -l and extract measurement."""
 
     with open(fname, "r", encoding="utf-8") as pkglist:
         # minus header
-        count = len(pkglist.readlines()) - 5
+        count = sum(1 for _ in pkglist) - 5
 
     point["fields"] = {"pkgcount": int(count)}
 
 
+@register_parser("metric_meminfo", "meminfo",
+                 ("MemFree", "MemAvailable", "Mlocked", "AnonPages", "Mapped",
+                  "Shmem", "MemTotal", "SwapTotal", "SwapFree", "Dirty",
+                  "Buffers", "Cached", "KReclaimable"), delta=True)
 def parse_meminfo_measurement(fname, point):
     """Parse raw data of meminfo output and extract measurement."""
 
     meminfo = {}
     with open(fname, "r", encoding="utf-8") as rawdataf:
-        meminfo_lines = rawdataf.readlines()
-        for line in meminfo_lines:
+        for line in rawdataf:
             lineinfo = line.split()
             meminfo[lineinfo[0]] = lineinfo[1]
 
@@ -207,15 +283,21 @@ def parse_meminfo_measurement(fname, point):
     }
 
 
+SERVICESECURITY_FIELDS = ("mean", "OK", "MEDIUM", "EXPOSED", "UNSAFE")
+
+
+@register_parser("metric_userservicesecurity", "userservicesecurity",
+                 SERVICESECURITY_FIELDS, delta=True)
+@register_parser("metric_systemservicesecurity", "systemservicesecurity",
+                 SERVICESECURITY_FIELDS, delta=True)
 def parse_servicesecurity_measurement(fname, point):
     """Parse output of systemd-analyze into avg and buckets."""
 
     with open(fname, "r", encoding="utf-8") as rawdataf:
         next(rawdataf)
-        ssec_lines = rawdataf.readlines()
         ssec_exposure = []
         ssec_predicate = []
-        for ssec_line in ssec_lines:
+        for ssec_line in rawdataf:
             elements = ssec_line.split()
             ssec_exposure.append(float(elements[1]))
             ssec_predicate.append(elements[2])
@@ -229,10 +311,71 @@ def parse_servicesecurity_measurement(fname, point):
     }
 
 
-def main(fname, metrictype, dryrun):
-    """Take raw measurement, parse it, feed it to InfluxDB."""
+# Largest directories (at depth DISKDETAIL_DEPTH, e.g. /usr/share/doc) and
+# packages reported, in KiB, as <metrictype>_top points tagged with their
+# name: as fields, the ever changing names would make an ever wider schema.
+TOP_N = 10
+DISKDETAIL_DEPTH = 3
+
+
+@register_parser("metric_diskdetail", "diskdetail", ("total",),
+                 top="path")
+def parse_diskdetail_measurement(fname, point):
+    """Parse raw data of du on / into total and largest directories."""
+
+    total = None
+
+    def directories(rawdataf):
+        nonlocal total
+        for line in rawdataf:
+            size, _, path = line.rstrip("\n").partition("\t")
+            if path == "/":
+                total = int(size)
+            elif path.count("/") == DISKDETAIL_DEPTH:
+                yield int(size), path
+
+    # nlargest keeps only TOP_N entries, whatever the size of the file
+    with open(fname, "r", encoding="utf-8") as rawdataf:
+        top = heapq.nlargest(TOP_N, directories(rawdataf))
+
+    if total is None:
+        print("WARNING: du output has no total for /!")
+        return
+
+    point["fields"] = {"total": total}
+    point["top"] = {path: size for size, path in top}
+
+
+@register_parser("metric_packagesizes", "packagesizes", ("total",),
+                 top="package")
+def parse_packagesizes_measurement(fname, point):
+    """Parse raw data of dpkg-query sizes into total and largest packages."""
+
+    total = 0
+
+    def packages(rawdataf):
+        nonlocal total
+        for line in rawdataf:
+            size, _, package = line.rstrip("\n").partition("\t")
+            # virtual or removed packages have no Installed-Size
+            if size and package:
+                total += int(size)
+                yield int(size), package
+
+    with open(fname, "r", encoding="utf-8") as rawdataf:
+        top = heapq.nlargest(TOP_N, packages(rawdataf))
+
+    point["fields"] = {"total": total}
+    point["top"] = {package: size for size, package in top}
+
+
+def build_points(fname, metrictype):
+    """Parse a raw measurement into data points, [] if no fields.
+
+    That is one point, followed by the <metrictype>_top points of the
+    parsers with top.
+    """
 
-    data = []
     tokens = filename_to_tokens(fname)
     point = {
         "time": tokens["timestamp"],
@@ -257,47 +400,693 @@ def main(fname, metrictype, dryrun):
         point["tags"]["stage"] = tokens["stage"]
         point["tags"]["machineid"] = tokens["machineid"]
 
-    if metrictype == "ssh_noninteractive":
-        parse_ssh_measurement(fname, point)
-    elif metrictype == "metric_processcount":
-        parse_processcount_measurement(fname, point)
-    elif metrictype == "metric_cpustat":
-        parse_cpustat_measurement(fname, point)
-    elif metrictype == "metric_meminfo":
-        parse_meminfo_measurement(fname, point)
-    elif metrictype == "metric_ports":
-        parse_ports_measurement(fname, point)
-    elif metrictype == "metric_disk":
-        parse_disk_measurement(fname, point)
-    elif metrictype == "metric_apt":
-        parse_apt_measurement(fname, point)
-    elif metrictype == "metric_packages":
-        parse_packages_measurement(fname, point)
-    elif metrictype == "metric_userservicesecurity":
-        parse_servicesecurity_measurement(fname, point)
-    elif metrictype == "metric_systemservicesecurity":
-        parse_servicesecurity_measurement(fname, point)
+    parser = PARSERS.get(metrictype)
+    if parser:
+        parser.parse(fname, point)
     else:
-        data = None
         print(f"WARNING: unknown metric type {metrictype}!")
 
-    if "fields" in point:
-        data.append(point)
-        print(data)
+    if "fields" not in point:
+        print(f"WARNING: no measurements found in {fname} => {point}!")
+        return []
+
+    if parser.fields is not None and tuple(point["fields"]) != parser.fields:
+        print(f"WARNING: {metrictype} fields {tuple(point['fields'])} "
+              f"differ from its schema {parser.fields}!")
+
+    points = [point]
+    for name, size in point.pop("top", {}).items():
+        points.append({
+            "time": point["time"],
+            "measurement": metrictype + "_top",
+            "tags": {**point["tags"], parser.top: name},
+            "fields": {"size": size},
+        })
+    return points
+
+
+# Line protocol escapes, see
+# https://docs.influxdata.com/influxdb/v1/write_protocols/line_protocol_reference/
+MEASUREMENT_ESCAPES = str.maketrans({",": r"\,", " ": r"\ "})
+KEY_ESCAPES = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ "})
+STRING_ESCAPES = str.maketrans({'"': r'\"', "\\": r"\\"})
+
+
+@lru_cache(maxsize=4096)
+def encode_series(measurement, tags):
+    """Line protocol series key of a measurement and (key, value) tags."""
+    series = [measurement.translate(MEASUREMENT_ESCAPES)]
+    for key, value in sorted(tags):
+        value = str(value)
+        if value:
+            series.append(f"{key.translate(KEY_ESCAPES)}="
+                          f"{value.translate(KEY_ESCAPES)}")
+    return ",".join(series)
+
+
+def encode_field(value):
+    """Line protocol field value."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return f'"{str(value).translate(STRING_ESCAPES)}"'
+
+
+@lru_cache(maxsize=4096)
+def encode_timestamp(timestamp):
+    """Nanosecond epoch of a result file timestamp (or any RFC3339 date)."""
+    date = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    seconds = date - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (seconds // timedelta(microseconds=1)) * 1000
+
+
+def encode_point(point):
+    """Encode a point (as built by build_points) to a line of line protocol.
+
+    The series key and timestamp of the result files repeat a lot, so
+    both are cached.
+    """
+    fields = ",".join(f"{key.translate(KEY_ESCAPES)}={encode_field(value)}"
+                      for key, value in point["fields"].items())
+    series = encode_series(point["measurement"],
+                           tuple(point["tags"].items()))
+    return f"{series} {fields} {encode_timestamp(point['time'])}"
+
+
+class LineFile:
+    """Line protocol output to a file (gzip-compressed if *.gz) or stream.
+
+    Same write interface as InfluxDBClient, for offline use.
+    """
+
+    def __init__(self, output):
+        if not isinstance(output, str):
+            self.file = output
+        elif output.endswith(".gz"):
+            self.file = gzip.open(output, "at", encoding="utf-8")
+        else:
+            self.file = open(output, "a", encoding="utf-8")
+
+    def write_points(self, lines, protocol="line"):
+        """Append lines of line protocol (the only protocol supported)."""
+        assert protocol == "line"
+        self.file.write("\n".join(lines) + "\n")
+        return True
+
+    def close(self):
+        if self.file in (sys.stdout, sys.__stdout__):
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+# Stages of metric-server-simple.sh, diffed into <metrictype>_delta points
+DELTA_STAGES = ("early", "loaded")
+
+
+def stage_deltas(entries):
+    """Diff stage: pass entries through, adding loaded - early deltas.
+
+    The points of the metric types registered with delta are paired by
+    run (all the tags but stage, and time). Once both stages of a run are
+    seen, a <metrictype>_delta point with the difference of every field
+    is added, tagged like its sources minus stage, as an entry with no
+    file. Only the unpaired points are kept, and the walker yields the
+    stages of a run next to each other.
+    """
+
+    pending = {}
+    for entry in entries:
+        yield entry
+        for point in entry[2] or ():
+            parser = PARSERS.get(point["measurement"])
+            if parser is None or not parser.delta:
+                continue
+            tags = dict(point["tags"])
+            stage = tags.pop("stage", None)
+            if stage not in DELTA_STAGES:
+                continue
+
+            key = (point["measurement"], point["time"],
+                   tuple(sorted(tags.items())))
+            other = pending.pop(key, None)
+            if other is None or other["tags"]["stage"] == stage:
+                pending[key] = point
+                continue
+            early, loaded = ((other, point) if stage == DELTA_STAGES[1]
+                             else (point, other))
+            yield None, None, [{
+                "time": point["time"],
+                "measurement": point["measurement"] + "_delta",
+                "tags": tags,
+                "fields": {field: (loaded["fields"][field]
+                                   - early["fields"][field])
+                           for field in parser.fields},
+            }]
+
+
+def delta_sibling(fname):
+    """The result file of the other stage of a delta pair, None if none."""
+    metrictype = metrictype_from_filename(fname)
+    if metrictype is None or not PARSERS[metrictype].delta:
+        return None
+    stage = filename_to_tokens(os.path.basename(fname))["stage"]
+    if stage not in DELTA_STAGES:
+        return None
+    other = DELTA_STAGES[1 - DELTA_STAGES.index(stage)]
+    return re.sub(rf"-{stage}(\.\w+)$", rf"-{other}\1", fname)
+
+
+def find_result_files(path):
+    """Lazily walk the result files in a directory tree, or a glob.
+
+    Directories are walked in sorted order, so that the files of a run
+    (e.g. its early and loaded stages) come out next to each other.
+    """
+    if not os.path.isdir(path):
+        yield from glob.iglob(path, recursive=True)
+        return
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.startswith("results-"):
+                yield os.path.join(dirpath, filename)
+
+
+class Ledger:
+    """Local record of the result files already ingested.
+
+    Files are keyed by path, size, mtime and content hash, and mapped to
+    their outcome: "points" once their points were written to InfluxDB,
+    with the identity (measurement, tags, time) of the first one, "empty"
+    if they had no point, "error" if they could not be parsed (delete
+    these rows to parse them again, e.g. after a parser fix). A file is
+    known if its path, size and mtime match, or if its content hash still
+    matches after a stat change (e.g. a copy of the archive).
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS ingested (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    sha256 TEXT,
+                    point TEXT,
+                    outcome TEXT
+                )""")
+            # ledgers from before outcome: all their files had points
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(ingested)")]
+            if "outcome" not in columns:
+                self.db.execute("ALTER TABLE ingested ADD COLUMN outcome TEXT "
+                                "DEFAULT 'points'")
+
+    def is_known(self, fname):
+        """Check whether fname was already ingested, unchanged."""
+        fstat = os.stat(fname)
+        path = os.path.abspath(fname)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, sha256 FROM ingested WHERE path = ?",
+                (path,)).fetchone()
+        if row is None:
+            return False
+        if row[:2] == (fstat.st_size, fstat.st_mtime_ns):
+            return True
+        if row[0] != fstat.st_size or row[2] != file_digest(fname):
+            return False
+
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE ingested SET mtime_ns = ? WHERE path = ?",
+                (fstat.st_mtime_ns, path))
+        return True
+
+    def record(self, entries):
+        """Record the (fname, sha256, points) entries as ingested."""
+        rows = []
+        for fname, digest, points in entries:
+            # derived points have no file
+            if fname is None:
+                continue
+            fstat = os.stat(fname)
+            identity = None
+            if points is None:
+                outcome = "error"
+            elif not points:
+                outcome = "empty"
+            else:
+                outcome = "points"
+                # the others are the <metrictype>_top points, if any
+                identity = json.dumps(
+                    {key: points[0][key]
+                     for key in ("measurement", "tags", "time")},
+                    sort_keys=True)
+            rows.append((os.path.abspath(fname), fstat.st_size,
+                         fstat.st_mtime_ns, digest, identity, outcome))
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+
+
+class Spool:
+    """Durable write-behind buffer of points, in a local directory.
+
+    Points are appended as line protocol to a segment file, one gzip
+    member per write, synced to disk before returning. Segments are
+    named <time_ns>-<pid>.lp.gz and written as .part files until sealed,
+    on close or once they reach segment_size bytes. flush_spool drains
+    the sealed segments to InfluxDB, oldest first.
+    """
+
+    suffix = ".lp.gz"
+
+    def __init__(self, path, segment_size=16 << 20):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segment = None
+        os.makedirs(path, exist_ok=True)
+
+    def write_points(self, lines, protocol="line"):
+        """Append lines of line protocol, same interface as InfluxDBClient."""
+        assert protocol == "line"
+        data = gzip.compress(("\n".join(lines) + "\n").encode())
+        with self.lock:
+            if self.segment is None:
+                name = f"{time.time_ns():020d}-{os.getpid()}{self.suffix}"
+                self.segment = open(
+                    os.path.join(self.path, name + ".part"), "ab")
+            self.segment.write(data)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            if self.segment.tell() >= self.segment_size:
+                self.seal()
+        return True
+
+    def seal(self):
+        """Close the current segment, making it available to flush."""
+        if self.segment is None:
+            return
+        self.segment.close()
+        os.rename(self.segment.name, self.segment.name[:-len(".part")])
+        self.segment = None
+
+    def close(self):
+        with self.lock:
+            self.seal()
+
+    def segments(self):
+        """Sealed segments, oldest first.
+
+        The .part segments of dead processes are sealed here: their
+        complete gzip members are still valid.
+        """
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix + ".part"):
+                continue
+            pid = int(name[:-len(self.suffix + ".part")].split("-")[1])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                partname = os.path.join(self.path, name)
+                os.rename(partname, partname[:-len(".part")])
+            except PermissionError:
+                pass
+        return sorted(os.path.join(self.path, name)
+                      for name in os.listdir(self.path)
+                      if name.endswith(self.suffix))
+
+
+def read_segment(fname):
+    """Yield the line-protocol lines of a spool segment.
+
+    Only complete gzip members are read: a truncated trailing member
+    (from an interrupted write) is ignored.
+    """
+
+    with open(fname, "rb") as segmentf:
+        decompressor = zlib.decompressobj(wbits=31)
+        member = []
+        for block in iter(lambda: segmentf.read(1 << 16), b""):
+            while block:
+                member.append(decompressor.decompress(block))
+                if not decompressor.eof:
+                    break
+                yield from b"".join(member).decode().splitlines()
+                block = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                member = []
+        if member:
+            print(f"WARNING: truncated spool segment {fname}")
+
+
+def flush_spool(spool, client, batch_size, retries=8, max_backoff=300):
+    """Drain the sealed segments of a spool to InfluxDB.
+
+    Lines are written in batches of batch_size. A failed write is retried
+    with exponential backoff, up to retries times, after which the error
+    is raised and the remaining segments are left in the spool. Client
+    errors (4xx) are not retried: a segment whose points InfluxDB rejects
+    (400, e.g. a field type conflict) is moved to the rejected/ directory
+    of the spool and the flush goes on, other client errors (e.g. bad
+    credentials) are raised. Segments are deleted once fully written:
+    re-sending part of a segment after an error is harmless, InfluxDB
+    overwrites points of same series and time. Only one flusher runs at a
+    time on a spool. Returns the line count.
+    """
+
+    with open(os.path.join(spool.path, ".flush.lock"), "w") as lockf:
+        try:
+            fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"WARNING: {spool.path} is already being flushed")
+            return 0
+
+        def write(batch):
+            for attempt in range(retries + 1):
+                try:
+                    client.write_points(batch, protocol="line")
+                    return
+                except Exception as exc:
+                    if attempt == retries or is_client_error(exc):
+                        raise
+                    backoff = min(max_backoff, 2 ** attempt)
+                    print(f"WARNING: InfluxDB write failed ({exc}), "
+                          f"retrying in {backoff}s")
+                    time.sleep(backoff)
+
+        total = 0
+        rejected = os.path.join(spool.path, "rejected")
+        for segment in spool.segments():
+            lines = read_segment(segment)
+            try:
+                for batch in iter(lambda: list(islice(lines, batch_size)),
+                                  []):
+                    write(batch)
+                    total += len(batch)
+            except InfluxDBClientError as exc:
+                if exc.code != 400:
+                    raise
+                os.makedirs(rejected, exist_ok=True)
+                os.rename(segment, os.path.join(rejected,
+                                                os.path.basename(segment)))
+                print(f"WARNING: InfluxDB rejected {segment} ({exc}), "
+                      f"moved to {rejected}")
+                continue
+            os.remove(segment)
+        return total
+
+
+def is_client_error(exc):
+    """Check whether an InfluxDB error is a client (4xx) one."""
+    return (isinstance(exc, InfluxDBClientError) and exc.code is not None
+            and 400 <= exc.code < 500)
+
+
+def file_digest(fname):
+    """SHA256 of the content of a file."""
+    sha256 = hashlib.sha256()
+    with open(fname, "rb") as rawdataf:
+        for block in iter(lambda: rawdataf.read(1 << 16), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def parse_result_files(fnames, digest=False):
+    """Parse stage worker: parse a chunk of files.
+
+    Returns a (fname, sha256, points) entry per file of a known metric
+    type, sha256 being None unless digest is set, and points the list of
+    its points, or None if it could not be parsed (e.g. empty or
+    truncated), with a warning.
+    """
+
+    entries = []
+    for fname in fnames:
+        metrictype = metrictype_from_filename(fname)
+        if metrictype is None:
+            continue
+        try:
+            points = build_points(fname, metrictype)
+        except Exception as exc:
+            print(f"WARNING: skipping {fname}: {exc!r}")
+            points = None
+        try:
+            sha256 = file_digest(fname) if digest else None
+        except OSError as exc:
+            print(f"WARNING: skipping {fname}: {exc!r}")
+            continue
+        entries.append((fname, sha256, points))
+    return entries
+
+
+def parse_parallel(fnames, jobs=None, chunk_size=64, max_pending=None,
+                   digest=False):
+    """Parse stage: yield the entries of fnames, parsed on a process pool.
+
+    Files are sent to the workers in chunks, with at most max_pending
+    chunks in flight, so memory use does not depend on the number of
+    files. Entries (see parse_result_files) come out in the order of
+    fnames. A chunk whose worker failed is skipped with a warning; if the
+    pool itself broke (e.g. a worker was killed), the error is raised.
+    Chunks still pending when the generator is closed are cancelled.
+    """
+
+    if max_pending is None:
+        max_pending = 4 * (jobs or os.cpu_count() or 1)
+
+    def results(future, chunk):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as exc:
+            print(f"WARNING: skipping {len(chunk)} files from {chunk[0]}: "
+                  f"{exc!r}")
+            return []
+
+    fnames = iter(fnames)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        try:
+            chunks = iter(lambda: list(islice(fnames, chunk_size)), [])
+            for chunk in chunks:
+                pending.append(
+                    (pool.submit(parse_result_files, chunk, digest), chunk))
+                if len(pending) >= max_pending:
+                    yield from results(*pending.popleft())
+            while pending:
+                yield from results(*pending.popleft())
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+
+def write_batches(entries, client, batch_size, dryrun, errors,
+                  ledger=None):
+    """Writer stage: write the points of the entries in a queue in batches.
+
+    Stops at the None sentinel. Batches are made of whole entries, of at
+    least batch_size points, so that the files of a batch (with points or
+    not) are recorded in the ledger, if any, once all their points are
+    written. On error the exception is saved in errors, so that the
+    producer stops, and the queue is drained until the sentinel, so that
+    the producer never blocks.
+    """
+
+    batch = []
+    npoints = 0
+
+    def flush():
+        nonlocal npoints
+        points = [point for _, _, points in batch for point in points or ()]
+        if dryrun:
+            print(points)
+        else:
+            if points:
+                client.write_points(
+                    [encode_point(point) for point in points],
+                    protocol="line")
+            if ledger:
+                ledger.record(batch)
+        batch.clear()
+        npoints = 0
+
+    try:
+        for entry in iter(entries.get, None):
+            batch.append(entry)
+            npoints += len(entry[2] or ())
+            if npoints >= batch_size:
+                flush()
+        if batch:
+            flush()
+    except Exception as exc:
+        errors.append(exc)
+        while entries.get() is not None:
+            pass
+
+
+def main(fname, metrictype, dryrun, sink=None):
+    """Take raw measurement, parse it, feed it to InfluxDB (or a sink)."""
+
+    points = build_points(fname, metrictype)
+    if points:
+        print(points)
 
         if not dryrun:
-            client = influx_connect()
-            client.write_points(data)
+            client = sink or influx_connect()
+            client.write_points([encode_point(point) for point in points],
+                                protocol="line")
 
-    else:
-        print(f"WARNING: no measurements found in {fname} => {point}!")
+
+def main_flush(spool, batch_size, retries):
+    """Drain a spool to InfluxDB."""
+
+    client = influx_connect()
+    total = flush_spool(spool, client, batch_size, retries)
+    print(f"{total} points flushed from {spool.path}")
+
+
+def main_dir(path, dryrun, batch_size, jobs=None, ledger_path=None,
+             sink=None, deltas=True):
+    """Parse all the result files in path, feed them to InfluxDB.
+
+    The files are streamed through three stages: a directory walker, a
+    parallel parser and a single writer, which writes the points in
+    batches of batch_size over one connection. The stages are connected
+    by bounded queues. The metric type of each file is inferred from its
+    name. With a ledger, files already ingested are skipped by the walker
+    (unless the other stage of their delta pair is new), and the files
+    parsed are recorded once their points are written to InfluxDB. With a
+    sink (a Spool or LineFile), points are written to it instead of
+    InfluxDB, and nothing is recorded in the ledger: the points are not in
+    InfluxDB yet. With deltas, the points diffed between stages are added
+    by a stage_deltas stage after the parser.
+    """
+
+    client = None if dryrun else sink or influx_connect()
+    ledger = Ledger(ledger_path) if ledger_path else None
+    entries = Queue(maxsize=2 * batch_size)
+    errors = []
+    writer = threading.Thread(target=write_batches,
+                              args=(entries, client, batch_size, dryrun,
+                                    errors, None if sink else ledger))
+    writer.start()
+
+    # Only the files of a known metric type are considered (e.g. not the
+    # ssh "first" files, read with their "warm" one)
+    fnames = filter(metrictype_from_filename, find_result_files(path))
+    skipped = 0
+    if ledger:
+        def unknown(fname):
+            nonlocal skipped
+            known = ledger.is_known(fname)
+            if known and deltas:
+                # Parsed again, for the delta, with a new other stage
+                sibling = delta_sibling(fname)
+                known = not (sibling and os.path.exists(sibling)
+                             and not ledger.is_known(sibling))
+            skipped += known
+            return not known
+        fnames = filter(unknown, fnames)
+
+    parsed = parse_parallel(fnames, jobs, digest=bool(ledger))
+    if deltas:
+        parsed = stage_deltas(parsed)
+
+    total = 0
+    try:
+        for entry in parsed:
+            # No point in parsing further once the writer failed
+            if errors:
+                break
+            entries.put(entry)
+            total += len(entry[2] or ())
+    finally:
+        parsed.close()
+        entries.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    print(f"{total} points from {path}, {skipped} files already ingested")
 
 
 if __name__ == "__main__":
     PARSER = argparse.ArgumentParser()
     PARSER.add_argument("--dryrun", action="store_true")
-    PARSER.add_argument("-f", "--fname", help="Input file name", required=True)
-    PARSER.add_argument("-t", "--metrictype", help="Metric type to parse",
-                        required=True)
+    INPUT = PARSER.add_mutually_exclusive_group()
+    INPUT.add_argument("-f", "--fname", help="Input file name")
+    INPUT.add_argument("-d", "--dir",
+                       help="Directory (or glob) of result files to parse, "
+                            "inferring the metric type from file names")
+    PARSER.add_argument("-t", "--metrictype", choices=tuple(PARSERS),
+                        help="Metric type to parse")
+    PARSER.add_argument("--batch-size", type=int, default=5000,
+                        help="Points per InfluxDB write in --dir mode")
+    PARSER.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Parser processes in --dir mode (default: "
+                             "number of CPUs)")
+    PARSER.add_argument("--no-deltas", dest="deltas", action="store_false",
+                        help="Do not add the *_delta points (loaded - early "
+                             "stage) in --dir mode")
+    PARSER.add_argument("--ledger",
+                        help="Ingestion ledger (SQLite), to skip the files "
+                             "already ingested in --dir mode: written to "
+                             "InfluxDB, without points or unparsable "
+                             "(--spool and -o writes are not recorded)")
+    OUTPUT = PARSER.add_mutually_exclusive_group()
+    OUTPUT.add_argument("--spool",
+                        help="Append the points to this spool directory "
+                             "instead of writing them to InfluxDB")
+    OUTPUT.add_argument("-o", "--output",
+                        help="Write the points as line protocol to this "
+                             "file (gzip-compressed if *.gz, - for stdout) "
+                             "instead of InfluxDB")
+    PARSER.add_argument("--flush", action="store_true",
+                        help="Drain the --spool directory to InfluxDB "
+                             "(after parsing the input, if any)")
+    PARSER.add_argument("--flush-retries", type=int, default=8,
+                        help="Retries of a failed write when flushing, with "
+                             "exponential backoff")
     ARGS = PARSER.parse_args()
-    main(ARGS.fname, ARGS.metrictype, ARGS.dryrun)
+    if ARGS.flush and not ARGS.spool:
+        PARSER.error("--flush requires --spool")
+    if not (ARGS.fname or ARGS.dir or ARGS.flush):
+        PARSER.error("one of the arguments -f/--fname -d/--dir "
+                     "--flush is required")
+    if ARGS.fname and not ARGS.metrictype:
+        PARSER.error("--metrictype is required with --fname")
+
+    SINK = None
+    if ARGS.spool:
+        SINK = Spool(ARGS.spool)
+    elif ARGS.output == "-":
+        # Keep stdout for the line protocol only
+        SINK = LineFile(sys.stdout)
+        sys.stdout = sys.stderr
+    elif ARGS.output:
+        SINK = LineFile(ARGS.output)
+    try:
+        if ARGS.dir:
+            main_dir(ARGS.dir, ARGS.dryrun, ARGS.batch_size, ARGS.jobs,
+                     ARGS.ledger, SINK, ARGS.deltas)
+        elif ARGS.fname:
+            main(ARGS.fname, ARGS.metrictype, ARGS.dryrun, SINK)
+    finally:
+        if SINK:
+            SINK.close()
+    if ARGS.flush:
+        main_flush(SINK, ARGS.batch_size, ARGS.flush_retries)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Run the metric-server-simple.sh matrix on concurrent LXD instances.
+
+Every (release, container/vm, size) combination is measured by its own
+metric-server-simple.sh run, in its own output directory. A size cN-mM
+is an instance of N CPUs and M GiB of memory: each instance is pinned to
+N host CPUs which no other running instance uses (via LIMITS_CPU, see
+metric-server-simple.sh), so that concurrent measurements do not disturb
+each other, and limited to M GiB (LIMITS_MEMORY). A run starts once
+enough host CPUs and available memory are free, with at most
+--concurrency runs active at once.
+"""
+
+import argparse
+import itertools
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "metric-server-simple.sh")
+REMOTE = "ubuntu-minimal-daily"
+REMOTE_URL = "https://cloud-images.ubuntu.com/minimal/daily/"
+
+
+def parse_size(size):
+    """Parse an instance size (e.g. c2-m4) into (cpu, mem)."""
+    match = re.fullmatch(r"c(\d+)-m(\d+)", size)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size {size}, e.g. c2-m4")
+    return int(match.group(1)), int(match.group(2))
+
+
+def cpu_set(cpus):
+    """Format sorted CPU numbers as an LXD limits.cpu set.
+
+    Always ranges (e.g. 3-3, 4-7 or 0-1,4-5): LXD reads a bare number as
+    a CPU count, not as a CPU to pin.
+    """
+    ranges = []
+    for cpu in cpus:
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{first}-{last}" for first, last in ranges)
+
+
+def available_memory_gib():
+    """MemAvailable of the host, in GiB."""
+    with open("/proc/meminfo", encoding="utf-8") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / (1 << 20)
+    return 0
+
+
+class HostResources:
+    """The host CPUs and memory (GiB) not used by the running instances."""
+
+    def __init__(self, cpus, memory):
+        self.cpus = sorted(cpus)
+        self.memory = memory
+        self.changed = threading.Condition()
+
+    def fits(self, cpu, mem):
+        """Check whether an instance of this size fits the host at all."""
+        return cpu <= len(self.cpus) and mem <= self.memory
+
+    @contextmanager
+    def reserve(self, cpu, mem):
+        """Wait for cpu free CPUs and mem GiB, yield the LXD CPU set."""
+        with self.changed:
+            self.changed.wait_for(
+                lambda: len(self.cpus) >= cpu and self.memory >= mem)
+            cpus = self.cpus[:cpu]
+            del self.cpus[:cpu]
+            self.memory -= mem
+        try:
+            yield cpu_set(cpus)
+        finally:
+            with self.changed:
+                self.cpus = sorted(self.cpus + cpus)
+                self.memory += mem
+                self.changed.notify_all()
+
+
+def setup_remote():
+    """Add the image remote of metric-server-simple.sh, once.
+
+    Concurrent first runs of the script would race adding it.
+    """
+    remotes = subprocess.run(["lxc", "remote", "list", "--format", "csv"],
+                             check=True, capture_output=True,
+                             text=True).stdout
+    if not any(line.startswith(f"{REMOTE},") for line in remotes.splitlines()):
+        subprocess.run(["lxc", "remote", "add", "--protocol",
+                        "simplestreams", REMOTE, REMOTE_URL], check=True)
+
+
+def run_one(combination, resources, outdir, dryrun):
+    """Run metric-server-simple.sh for a combination, once it fits.
+
+    Returns (name, return code, duration in seconds).
+    """
+
+    release, what, (cpu, mem) = combination
+    name = f"{release}-{what}-c{cpu}-m{mem}"
+    rundir = os.path.join(outdir, name)
+    env = dict(os.environ, RELEASE=release, WHAT=what, CPU=str(cpu),
+               MEM=str(mem), LIMITS_MEMORY=f"{mem}GiB")
+
+    with resources.reserve(cpu, mem) as cpus:
+        env["LIMITS_CPU"] = cpus
+        print(f"{name}: starting on CPUs {cpus}")
+        if dryrun:
+            return name, 0, 0
+
+        os.makedirs(rundir, exist_ok=True)
+        start = time.monotonic()
+        with open(os.path.join(rundir, "run.log"), "w",
+                  encoding="utf-8") as log:
+            result = subprocess.run([SCRIPT], cwd=rundir, env=env,
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    check=False)
+        return name, result.returncode, time.monotonic() - start
+
+
+def main(releases, whats, sizes, concurrency, outdir, dryrun):
+    """Run the matrix, return the number of failed runs."""
+
+    resources = HostResources(os.sched_getaffinity(0),
+                              available_memory_gib())
+    for cpu, mem in sizes:
+        if not resources.fits(cpu, mem):
+            print(f"error: c{cpu}-m{mem} does not fit the host "
+                  f"({len(resources.cpus)} usable CPUs, "
+                  f"{resources.memory:.1f}GiB of available memory)")
+            return 1
+    if not concurrency:
+        concurrency = len(resources.cpus)
+
+    if not dryrun:
+        setup_remote()
+
+    combinations = list(itertools.product(releases, whats, sizes))
+    print(f"Running {len(combinations)} combinations, {concurrency} at once")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_one, combination, resources, outdir,
+                               dryrun)
+                   for combination in combinations]
+        for future in as_completed(futures):
+            name, returncode, duration = future.result()
+            status = "ok" if returncode == 0 else f"FAILED ({returncode})"
+            print(f"{name}: {status} in {duration:.0f}s")
+            failed += returncode != 0
+
+    return failed
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument("-r", "--releases",
+                        help="Comma separated releases (default: the "
+                             "development release)")
+    PARSER.add_argument("-w", "--what", default="container,vm",
+                        help="Comma separated instance kinds "
+                             "(default: %(default)s)")
+    PARSER.add_argument("-s", "--sizes", default="c1-m1",
+                        help="Comma separated sizes: cN-mM is N pinned "
+                             "host CPUs and M GiB of memory "
+                             "(default: %(default)s)")
+    PARSER.add_argument("-j", "--concurrency", type=int, default=None,
+                        help="Maximum concurrent instances (default: as many "
+                             "as the free host CPUs and memory allow)")
+    PARSER.add_argument("-o", "--outdir", default=".",
+                        help="Directory of the per-run result directories "
+                             "(default: %(default)s)")
+    PARSER.add_argument("--dryrun", action="store_true")
+    ARGS = PARSER.parse_args()
+
+    if ARGS.releases:
+        RELEASES = ARGS.releases.split(",")
+    else:
+        RELEASES = [subprocess.run(["distro-info", "--devel"], check=True,
+                                   capture_output=True,
+                                   text=True).stdout.strip()]
+    try:
+        SIZES = [parse_size(size) for size in ARGS.sizes.split(",")]
+    except argparse.ArgumentTypeError as exc:
+        PARSER.error(str(exc))
+
+    sys.exit(main(RELEASES, ARGS.what.split(","), SIZES, ARGS.concurrency,
+                  ARGS.outdir, ARGS.dryrun) != 0)
@@ -11,9 +11,13 @@ WHAT=${WHAT-container}
 CPU=${CPU-1}
 MEM=${MEM-1}
 INSTTYPE="c$CPU-m$MEM"
+# Host CPUs of the instance: a count, or a set (e.g. 0-3) to pin it
+LIMITS_CPU=${LIMITS_CPU-4}
+LIMITS_MEMORY=${LIMITS_MEMORY-4GiB}
 RELEASE=${RELEASE-$(distro-info --devel)}
 MACHINEID="unset"
 INSTNAME=${INSTNAME-metric-server-simple-$RELEASE-$WHAT-$INSTTYPE}
+SCRIPTDIR=$(dirname "$(readlink -f "$0")")
 
 cleanup() {
   if lxc info "$INSTNAME" >/dev/null 2>&1; then
@@ -44,7 +48,7 @@ Cexec() {
 setup_container() {
   [ "$WHAT" = vm ] && vmflag=--vm || vmflag=""
   # shellcheck disable=SC2086
-  lxc launch "ubuntu-minimal-daily:$RELEASE" "$INSTNAME" --ephemeral $vmflag -c limits.cpu=4 -c limits.memory=4GiB
+  lxc launch "ubuntu-minimal-daily:$RELEASE" "$INSTNAME" --ephemeral $vmflag -c limits.cpu="$LIMITS_CPU" -c limits.memory="$LIMITS_MEMORY"
 
   # Wait for instance to be able to accept commands
   retry -d 2 -t 90 -- lxc exec "$INSTNAME" true
@@ -79,22 +83,14 @@ install_dependencies() {
 }
 
 wait_load_settled() {
-  # Wait until load is load is settled
-  load_settled=false
-  for _ in $(seq 1 60); do
-    loadavg1=$(cexec cut -d ' ' -f 1 /proc/loadavg)
-    loadavg5=$(cexec cut -d ' ' -f 2 /proc/loadavg)
-    loadreldiff=$(echo "($loadavg1-$loadavg5)/$loadavg5" | bc -l)
-    absloadreldirr=$(echo "if ($loadreldiff < 0) {-($loadreldiff)} else {$loadreldiff}" | bc -l)
-    if [ "$(echo "$absloadreldirr < 0.07" | bc -l)" = 1 ]; then
-      load_settled=true
-      break
-    fi
-    sleep 10
-  done
-
-  if [ $load_settled != true ]; then
+  # Wait until load is settled, sampled in the instance (see the script)
+  rc=0
+  "$SCRIPTDIR/wait-load-settled.py" "$INSTNAME" || rc=$?
+  if [ $rc = 1 ]; then
     echo "WARNING: load didn't settle!"
+  elif [ $rc != 0 ]; then
+    echo "WARNING: could not sample the load, waiting a fixed 60s"
+    sleep 60
   fi
 }
 
@@ -162,7 +158,8 @@ do_measurement_disk() {
   resultfile=$(get_result_filename "disk" "txt")
   Cexec df / --block-size=1M > "${resultfile}"
 
-  # Not parsed (yet), but great for later debugging of differences
+  # Parsed into the total and largest directories, the full list is great
+  # for later debugging of differences
   resultfile=$(get_result_filename "diskdetail" "txt")
   Cexec du  / --exclude /dev --exclude /proc --exclude /sys --max-depth=4 >> "${resultfile}"
 }
@@ -171,7 +168,8 @@ do_measurement_package() {
   resultfile=$(get_result_filename "packages" "txt")
   Cexec dpkg -l > "${resultfile}"
 
-  # Not parsed (yet), but great for later debugging of differences
+  # Parsed into the total and largest packages, the full list is great for
+  # later debugging of differences
   resultfile=$(get_result_filename "packagesizes" "txt")
   # This is intentional expanded by dpkg-query
   # shellcheck disable=SC2016
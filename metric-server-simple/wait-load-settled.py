@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Wait until the load of an LXD instance is settled.
+
+A sampler running in the instance (one lxc exec) streams the CPU time
+counters of /proc/stat and the stall time counters of the cgroup of the
+instance (/sys/fs/cgroup/*.pressure: in a container, /proc/pressure is
+host-wide) every --interval seconds. On the host, they are turned into
+the CPU utilization and the cpu, io and memory stall fractions of each
+interval. Over a sliding --window, the load is settled when none of these
+moved: for each, the difference between the means of the two halves of
+the window is below --tolerance, or is not significant (Welch's t-test at
+--alpha). Exits 1 if the load did not settle within --timeout seconds,
+2 if the sampling failed.
+"""
+
+import argparse
+import math
+import os
+import select
+import statistics
+import subprocess
+import sys
+import time
+
+from collections import deque
+
+# Runs in the instance, with whatever python3 the release has.
+SAMPLER = r"""
+import os
+import sys
+import time
+
+interval = float(sys.argv[1])
+paths = ["/sys/fs/cgroup/%s.pressure"]
+# Without cgroup v2, the system-wide PSI is the instance one in VMs only
+if not os.path.exists("/run/systemd/container"):
+    paths.append("/proc/pressure/%s")
+while True:
+    with open("/proc/stat") as stat:
+        cpu = [int(value) for value in stat.readline().split()[1:9]]
+    sample = [time.monotonic(), sum(cpu), cpu[3] + cpu[4]]
+    for resource in ("cpu", "io", "memory"):
+        for path in paths:
+            try:
+                with open(path % resource) as pressure:
+                    some = pressure.readline()
+                sample.append(int(some.rsplit("=", 1)[1]))
+                break
+            except (OSError, IndexError, ValueError):
+                pass
+        else:
+            sample.append(-1)
+    print(*sample, flush=True)
+    time.sleep(interval)
+"""
+
+SERIES = ("cpu", "cpu_pressure", "io_pressure", "memory_pressure")
+
+
+class SamplerError(Exception):
+    """The sampler in the instance stopped."""
+
+
+def lines_until(stream, deadline):
+    """Yield the lines of a binary stream until EOF or the deadline."""
+    pending = b""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        ready, _, _ = select.select([stream], [], [], remaining)
+        if not ready:
+            return
+        data = os.read(stream.fileno(), 4096)
+        if not data:
+            raise EOFError
+        *lines, pending = (pending + data).split(b"\n")
+        yield from lines
+
+
+def sample(instance, interval, deadline):
+    """Yield the utilization and stall fractions of each interval.
+
+    Stops at the deadline (time.monotonic), even without new samples.
+    Raises SamplerError if the sampler stopped before.
+    """
+
+    sampler = subprocess.Popen(
+        ["lxc", "exec", instance, "--", "python3", "-c", SAMPLER,
+         str(interval)],
+        stdout=subprocess.PIPE)
+    try:
+        previous = None
+        for line in lines_until(sampler.stdout, deadline):
+            current = [float(value) for value in line.split()]
+            if previous:
+                elapsed = current[0] - previous[0]
+                total = current[1] - previous[1]
+                idle = current[2] - previous[2]
+                fractions = [1 - idle / total if total else 0.0]
+                # PSI totals are in microseconds, -1 if unavailable
+                for now, before in zip(current[3:], previous[3:]):
+                    if now < 0 or before < 0:
+                        fractions.append(0.0)
+                    else:
+                        fractions.append((now - before) / 1e6 / elapsed)
+                yield fractions
+            previous = current
+    except EOFError:
+        raise SamplerError(
+            f"sampler exited with status {sampler.wait()}") from None
+    finally:
+        sampler.kill()
+        sampler.wait()
+
+
+def welch_pvalue(first, second):
+    """Two-sided p-value of Welch's t-test (normal approximation)."""
+    stderr = math.sqrt(statistics.variance(first) / len(first)
+                       + statistics.variance(second) / len(second))
+    diff = statistics.mean(second) - statistics.mean(first)
+    if stderr == 0:
+        return 1.0 if diff == 0 else 0.0
+    return 2 * (1 - statistics.NormalDist().cdf(abs(diff) / stderr))
+
+
+def is_settled(window, tolerance, alpha):
+    """Check whether every series of a full window is stationary."""
+    half = len(window) // 2
+    for series in zip(*window):
+        first, second = series[:half], series[half:]
+        diff = abs(statistics.mean(second) - statistics.mean(first))
+        if diff >= tolerance and welch_pvalue(first, second) < alpha:
+            return False
+    return True
+
+
+def main(instance, interval, window_length, tolerance, alpha, timeout):
+    """Wait for the load of instance to settle, return whether it did."""
+
+    window = deque(maxlen=max(4, round(window_length / interval)))
+    start = time.monotonic()
+    for fractions in sample(instance, interval, start + timeout):
+        window.append(fractions)
+        if len(window) == window.maxlen and is_settled(window, tolerance,
+                                                       alpha):
+            means = ", ".join(f"{name} {statistics.mean(series):.3f}"
+                              for name, series in zip(SERIES, zip(*window)))
+            print(f"Load settled after {time.monotonic() - start:.0f}s "
+                  f"({means})")
+            return True
+
+    return False
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    PARSER.add_argument("instance", help="LXD instance name")
+    PARSER.add_argument("--interval", type=float, default=0.5,
+                        help="Sampling interval in seconds "
+                             "(default: %(default)s)")
+    PARSER.add_argument("--window", type=float, default=30,
+                        help="Sliding window in seconds "
+                             "(default: %(default)s)")
+    PARSER.add_argument("--tolerance", type=float, default=0.02,
+                        help="Change of utilization or stall fraction "
+                             "considered settled (default: %(default)s)")
+    PARSER.add_argument("--alpha", type=float, default=0.01,
+                        help="Significance level of the change "
+                             "(default: %(default)s)")
+    PARSER.add_argument("--timeout", type=float, default=600,
+                        help="Maximum wait in seconds "
+                             "(default: %(default)s)")
+    ARGS = PARSER.parse_args()
+    try:
+        sys.exit(not main(ARGS.instance, ARGS.interval, ARGS.window,
+                          ARGS.tolerance, ARGS.alpha, ARGS.timeout))
+    except SamplerError as exc:
+        print(f"error: {exc}")
+        sys.exit(2)